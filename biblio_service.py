@@ -0,0 +1,375 @@
+# -*- coding: utf-8 -*-
+
+"""
+A long-running local service harvesting link lists and laying them out,
+with the connections to DataBnF and the response cache kept warm
+between lists.
+
+Lists are sent as jobs over HTTP, on a port or a Unix socket, and run
+by a few worker threads, the most urgent first.
+
+From a terminal:
+    python gallica2biblio.py serve --port 8892
+    curl -d '{"links": ["https://gallica.bnf.fr/ark:/12148/bpt6k5474698z"],
+              "formats": ["docx", "bib"], "wait": true}' localhost:8892/jobs
+    curl -O localhost:8892/jobs/1/biblio.docx
+
+From Python:
+    with BiblioService(port=8892) as service:
+        ...
+"""
+
+import itertools
+import json
+import os
+import queue
+import shutil
+import socketserver
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+import utils
+
+######################################################
+
+# THE SERVICE
+
+# The options of parse_list() a job may set.
+JOB_OPTIONS = ["batch_size", "concurrency", "max_concurrency",
+               "result_format", "lean", "refresh", "retries"]
+
+class BiblioService:
+
+    """
+    A local service running harvest and layout jobs.
+
+    Each job is a list of links, harvested with parse_list() and laid out
+    with author_date() into the requested formats. All jobs share the
+    response cache and the pool of connections to the endpoint, which
+    stay open between jobs.
+
+    :param endpoint: A string containing the URL for the SPARQL endpoint.
+    :param cache: The path to the SQLite response cache, or None.
+    :param workers: The number of jobs running at the same time.
+    :param directory: The directory where the outputs of the jobs are
+        kept, or None for a temporary one, removed when the service stops.
+    :param options: Keyword arguments passed on to parse_list() for
+        every job (e.g. concurrency, batch_size).
+    :param host: The address to listen on.
+    :param port: The port to listen on (0 picks a free one).
+    :param socket: The path to a Unix socket to listen on instead
+        of a port, or None.
+
+    """
+
+    def __init__(self, endpoint="https://data.bnf.fr/sparql",
+                 cache="sparql_cache.sqlite", workers=2, directory=None,
+                 options=None, host="127.0.0.1", port=8892, socket=None):
+        self.endpoint = endpoint
+        self.cache = utils.QueryCache(cache) if isinstance(cache, str) \
+            else cache
+        self.workers = workers
+        self.temporary = directory is None
+        self.directory = directory or tempfile.mkdtemp(prefix="biblio_")
+        self.options = options or {}
+        self.host = host
+        self.port = port
+        self.socket = socket
+        self.server = None
+
+        # The jobs by id, and the queue of those waiting to run:
+        # (-priority, id), so that urgent and older jobs come first.
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.ids = itertools.count(1)
+        self.queue = queue.PriorityQueue()
+        self.threads = []
+
+    @property
+    def url(self):
+        if self.socket is not None:
+            return f"unix:{self.socket}"
+        return f"http://{self.host}:{self.port}"
+
+    def start(self):
+
+        """
+        Start answering requests and running jobs in background
+        threads, and return the service itself.
+
+        """
+
+        # One pool for all jobs: get_pool() would replace
+        # it for a job asking for another size or timeout.
+        self.options.setdefault("pool_size", 16)
+        self.options.setdefault("timeout", 120)
+        utils.get_pool(self.endpoint, self.options["pool_size"],
+                       self.options["timeout"])
+
+        if self.socket is not None:
+            if os.path.exists(self.socket):
+                os.remove(self.socket)
+            self.server = UnixHTTPServer(self.socket, Handler)
+        else:
+            self.server = ThreadingHTTPServer((self.host, self.port), Handler)
+            self.port = self.server.server_address[1]
+        self.server.daemon_threads = True
+        self.server.service = self
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self.run_jobs, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def stop(self):
+
+        """
+        Stop answering requests, and let the queued jobs finish.
+
+        """
+
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        if self.socket is not None and os.path.exists(self.socket):
+            os.remove(self.socket)
+
+        for _ in self.threads:
+            self.queue.put((float("inf"), 0))
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+        if self.temporary:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def submit(self, links, formats=("docx",), priority=0, **options):
+
+        """
+        Queue a job and return its id.
+
+        :param links: A list of URLs/URIs, as in the lines of the
+            files read by parse_list().
+        :param formats: The formats of the bibliography, as extensions
+            (see utils.BIBLIO_FORMATS).
+        :param priority: Jobs with a higher priority run first.
+        :param options: Keyword arguments passed on to parse_list()
+            (see JOB_OPTIONS).
+
+        """
+
+        for fmt in formats:
+            utils.biblio_format("biblio." + fmt)
+        unknown = set(options) - set(JOB_OPTIONS)
+        if unknown:
+            raise ValueError(f"Unknown options: {', '.join(sorted(unknown))}")
+
+        with self.lock:
+            i = next(self.ids)
+            self.jobs[i] = {
+                "id": i, "status": "queued", "links": len(links),
+                "formats": list(formats), "priority": priority,
+                "submitted": time.time(), "seconds": None,
+                "files": [], "error": None,
+                "done": threading.Event(),
+                "request": (links, options)}
+        self.queue.put((-priority, i))
+        return i
+
+    def status(self, i):
+
+        """
+        Return the status of a job, as a dict, or None for an unknown id.
+
+        :param i: The id of the job.
+
+        """
+
+        with self.lock:
+            job = self.jobs.get(i)
+            if job is None:
+                return None
+            return {k: v for k, v in job.items()
+                    if k not in ("done", "request")}
+
+    def wait(self, i, timeout=None):
+
+        """
+        Wait for a job to finish and return its status.
+
+        :param i: The id of the job.
+        :param timeout: The maximum number of seconds to wait.
+
+        """
+
+        self.jobs[i]["done"].wait(timeout)
+        return self.status(i)
+
+    def run_jobs(self):
+        # Run the queued jobs one after the other, until stopped.
+        while True:
+            _, i = self.queue.get()
+            if i == 0:
+                return
+            self.run(i)
+
+    def run(self, i):
+
+        """
+        Harvest the links of a job and lay them out.
+
+        :param i: The id of the job.
+
+        """
+
+        job = self.jobs[i]
+        with self.lock:
+            job["status"] = "running"
+            links, options = job.pop("request")
+        start = time.perf_counter()
+
+        folder = os.path.join(self.directory, str(i))
+        os.makedirs(folder, exist_ok=True)
+        try:
+            # parse_list() reads the links from a file.
+            path = os.path.join(folder, "links.txt")
+            with open(path, "w", encoding="utf-8") as f:
+                f.write("\n".join(links) + "\n")
+
+            table = utils.parse_list(
+                path, endpoint=self.endpoint, cache=self.cache,
+                journal=None, output=None, excel=None, preview=False,
+                **dict(self.options, **options))
+            files = ["biblio." + fmt for fmt in job["formats"]]
+            utils.author_date(table, output=[
+                os.path.join(folder, name) for name in files])
+        except Exception as error:
+            with self.lock:
+                job["status"] = "failed"
+                job["error"] = repr(error)
+        else:
+            with self.lock:
+                job["status"] = "done"
+                job["files"] = files
+        finally:
+            with self.lock:
+                job["seconds"] = time.perf_counter() - start
+            job["done"].set()
+
+    def file(self, i, name):
+        # The path to an output of a finished job, or None.
+        status = self.status(i)
+        if status is None or name not in status["files"]:
+            return None
+        return os.path.join(self.directory, str(i), name)
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    # The HTTP server, on a Unix socket.
+    pass
+
+######################################################
+
+# ANSWER THE REQUESTS
+
+# The MIME type of each output.
+MIME_TYPES = {
+    "docx": "application/vnd.openxmlformats-officedocument"
+            ".wordprocessingml.document",
+    "html": "text/html; charset=utf-8",
+    "htm": "text/html; charset=utf-8",
+    "bib": "application/x-bibtex; charset=utf-8",
+    "ris": "application/x-research-info-systems; charset=utf-8",
+    "json": "application/vnd.citationstyles.csl+json; charset=utf-8"
+}
+
+class Handler(BaseHTTPRequestHandler):
+
+    """
+    Answer the requests to a BiblioService:
+        POST /jobs                 queue a job (Json: links, formats,
+                                   priority, wait, and parse_list options)
+        GET  /jobs                 the status of all jobs
+        GET  /jobs/<id>            the status of a job
+        GET  /jobs/<id>/<file>     an output of a finished job
+
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        service = self.server.service
+        parts = urlsplit(self.path).path.strip("/").split("/")
+
+        if parts == ["jobs"]:
+            with service.lock:
+                ids = list(service.jobs)
+            return self.send_json(200, [service.status(i) for i in ids])
+
+        if len(parts) >= 2 and parts[0] == "jobs" and parts[1].isdigit():
+            i = int(parts[1])
+            if len(parts) == 2:
+                status = service.status(i)
+                if status is not None:
+                    return self.send_json(200, status)
+            elif len(parts) == 3:
+                path = service.file(i, parts[2])
+                if path is not None:
+                    return self.send_file(path)
+
+        self.send_json(404, {"error": "Not found."})
+
+    def do_POST(self):
+        service = self.server.service
+        if urlsplit(self.path).path.strip("/") != "jobs":
+            return self.send_json(404, {"error": "Not found."})
+
+        try:
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            request = json.loads(body or b"{}")
+            links = request.pop("links")
+            wait = request.pop("wait", False)
+            i = service.submit(links, **request)
+        except (KeyError, TypeError, ValueError) as error:
+            return self.send_json(400, {"error": repr(error)})
+
+        if wait:
+            return self.send_json(200, service.wait(i))
+        self.send_json(202, service.status(i))
+
+    def send_json(self, code, data):
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_file(self, path):
+        extension = os.path.splitext(path)[1].lstrip(".")
+        with open(path, "rb") as f:
+            body = f.read()
+        self.send_response(200)
+        self.send_header("Content-Type", MIME_TYPES.get(
+            extension, "application/octet-stream"))
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix sockets have no client address.
+        return str(self.client_address or "local")
+
+    def log_message(self, *args):
+        pass
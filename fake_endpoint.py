@@ -0,0 +1,547 @@
+# -*- coding: utf-8 -*-
+
+"""
+A local stand-in for the DataBnF SPARQL endpoint, to test and benchmark
+parse_list() and query_db() offline.
+
+It answers the query shapes built by utils.build_queries() (properties and
+contributors of the manifestations, or both at once) and the names of
+persons asked by utils.resolve_names(), with recorded or synthetic
+bindings, in Json, CSV or TSV, with configurable latency, error rate
+and payload size.
+
+From a terminal:
+    python fake_endpoint.py serve --port 8890 --latency 0.2
+    python fake_endpoint.py bench --links 500 --latency 0.2
+
+From Python:
+    endpoint = FakeEndpoint(latency=0.2).start()
+    parse_list("iiif_list.txt", endpoint=endpoint.url)
+    endpoint.stop()
+"""
+
+import argparse
+import csv
+import gzip
+import hashlib
+import io
+import json
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from utils import parse_list, values
+
+######################################################
+
+# SYNTHETIC DATA
+
+# Some of the properties and roles DataBnF uses.
+TITLE = "http://purl.org/dc/terms/title"
+DATE = "http://purl.org/dc/terms/date"
+FIRST_YEAR = "http://data.bnf.fr/ontology/bnf-onto/firstYear"
+PLACE = "http://rdvocab.info/Elements/placeOfPublication"
+PUBLISHER = "http://rdvocab.info/Elements/publishersName"
+DESCRIPTION = "http://purl.org/dc/terms/description"
+FRBNF = "http://data.bnf.fr/ontology/bnf-onto/FRBNF"
+REPRODUCTION = "http://rdvocab.info/RDARelationshipsWEMI/electronicReproduction"
+OTHER_PROPERTIES = [
+    "http://rdvocab.info/RDARelationshipsWEMI/expressionManifested",
+    "http://www.w3.org/1999/02/22-rdf-syntax-ns#type",
+    "http://rdaregistry.info/Elements/m/#P30004",
+    "http://purl.org/dc/terms/subject",
+    "http://purl.org/dc/terms/language",
+    "http://rdvocab.info/Elements/extentOfText"
+]
+ROLES = [
+    "http://data.bnf.fr/vocabulary/roles/r70",
+    "http://id.loc.gov/vocabulary/relators/aut",
+    "http://data.bnf.fr/vocabulary/roles/r360",
+    "http://purl.org/dc/terms/contributor",
+    "http://data.bnf.fr/vocabulary/roles/r80"
+]
+FAMILY_NAMES = ["Zola", "Hugo", "Sand", "Balzac", "Colette", "Flaubert",
+                "Staël", "Verne", "Maupassant", "Daudet", "Stendhal"]
+GIVEN_NAMES = ["Émile", "Victor", "George", "Honoré", "Sidonie-Gabrielle",
+               "Gustave", "Germaine", "Jules", "Guy", "Alphonse", "Henri"]
+PLACES = ["Paris (France)", "Lyon (France)", "Bruxelles (Belgique)",
+          "Genève (Suisse)"]
+# The URIs of the synthetic persons: cb1, then the indices
+# of their family and given names in FAMILY_NAMES and GIVEN_NAMES.
+PERSON = "http://data.bnf.fr/ark:/12148/cb1%03d%03d#about"
+PUBLISHERS = ["G. Charpentier", "Hachette", "Calmann-Lévy", "J. Hetzel",
+              "Michel Lévy frères"]
+
+######################################################
+
+# THE ENDPOINT
+
+class FakeEndpoint:
+
+    """
+    A local SPARQL endpoint answering the queries of utils.py.
+
+    Each link gets a record (properties and contributors), either from the
+    recorded records or generated from the link, so that the same link
+    always gets the same answer.
+
+    :param latency: The number of seconds before each answer.
+    :param jitter: A random number of seconds (up to jitter)
+        added to the latency.
+    :param error_rate: The share of requests answered with a 429 or 503
+        error instead of results.
+    :param retry_after: The Retry-After header (in seconds) sent with
+        the errors, or None for no header.
+    :param properties: The number of properties of each synthetic record.
+    :param contributors: The maximum number of contributors of each
+        synthetic record (at least 1).
+    :param value_length: The minimum length of the descriptions of the
+        synthetic records, to make the payload bigger.
+    :param missing_rate: The share of links with no record at all.
+    :param recorded: A dict of records (see load_records()), or the path
+        to a Json file holding them. Recorded links are answered as recorded,
+        the other links get synthetic records.
+    :param host: The address to listen on.
+    :param port: The port to listen on (0 picks a free one).
+
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0,
+                 retry_after=None, properties=12, contributors=3,
+                 value_length=0, missing_rate=0.0, recorded=None,
+                 host="127.0.0.1", port=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.properties = properties
+        self.contributors = max(1, contributors)
+        self.value_length = value_length
+        self.missing_rate = missing_rate
+        if isinstance(recorded, str):
+            recorded = load_records(recorded)
+        self.recorded = recorded or {}
+
+        # The recorded persons, by URI.
+        self.persons = {}
+        for record in self.recorded.values():
+            for contributor in record["contributors"]:
+                self.persons[person_uri(*contributor[1:])] = contributor[1:3]
+        self.host = host
+        self.port = port
+        self.server = None
+
+        # Some figures about what was asked.
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}/sparql"
+
+    def start(self):
+
+        """
+        Start answering queries in a background thread, and return
+        the endpoint itself.
+
+        """
+
+        self.server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.server.daemon_threads = True
+        self.server.endpoint = self
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+
+        """
+        Stop answering queries.
+
+        """
+
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def record(self, link):
+
+        """
+        Return the record of a link as a dict with the manifestation
+        ("source"), its properties ([property, value] pairs) and its
+        contributors ([role, family name, given name] triples, with the
+        URI of the person as a fourth item if it has one), or None if
+        the link has no record.
+
+        :param link: The link, as queried.
+
+        """
+
+        if link in self.recorded:
+            return self.recorded[link]
+
+        r = random.Random(link)
+        if r.random() < self.missing_rate:
+            return None
+
+        # A Gallica link is a reproduction of a manifestation,
+        # an ARK link is the manifestation itself.
+        if "gallica.bnf.fr" in link:
+            source = f"http://data.bnf.fr/ark:/12148/cb{r.randrange(10**8)}#about"
+        else:
+            source = link
+
+        year = r.randint(1800, 1940)
+        properties = [
+            [TITLE, f"Œuvre n° {r.randrange(10**6)}"],
+            [DATE, f"http://data.bnf.fr/date/{year}/"],
+            [FIRST_YEAR, str(year)],
+            [PLACE, r.choice(PLACES)],
+            [PUBLISHER, r.choice(PUBLISHERS)],
+            [FRBNF, f"FRBNF{r.randrange(10**8)}"],
+            [DESCRIPTION, "1 vol. (" + str(r.randint(50, 900)) + " p.) "
+             + "." * self.value_length]
+        ]
+        if "gallica.bnf.fr" in link:
+            properties.append([REPRODUCTION, link])
+        while len(properties) < self.properties:
+            properties.append([r.choice(OTHER_PROPERTIES),
+                               f"valeur {r.randrange(10**6)}"])
+
+        contributors = []
+        for _ in range(r.randint(1, self.contributors)):
+            fam, given = r.randrange(len(FAMILY_NAMES)), r.randrange(
+                len(GIVEN_NAMES))
+            contributors.append([r.choice(ROLES), FAMILY_NAMES[fam],
+                                 GIVEN_NAMES[given], PERSON % (fam, given)])
+
+        return {"source": source,
+                "properties": properties[:max(self.properties, 1)],
+                "contributors": contributors}
+
+    def answer(self, query):
+
+        """
+        Return the variables and the rows answering a query built
+        by utils.build_queries().
+
+        :param query: A string containing the query.
+
+        """
+
+        select = re.search(r"SELECT\s+(?:DISTINCT\s+)?(.*?)\s+WHERE",
+                           query, re.S)
+        variables = re.findall(r"\?(\w+)", select.group(1)) if select else []
+        links = values(query, "link")
+        wanted = values(query, "propriété")
+
+        # The names of persons, by URI.
+        if "nomFamille" in variables and "role" not in variables:
+            rows = []
+            for link in links:
+                names = self.person(link)
+                if names is not None:
+                    rows.append({"link": link, "nomFamille": names[0],
+                                 "prénom": names[1]})
+            return variables, rows
+
+        rows = []
+        for link in links:
+            record = self.record(link)
+            if record is None:
+                continue
+
+            properties = [p for p in record["properties"]
+                          if wanted is None or p[0] in wanted]
+            people = [c[:3] + [person_uri(*c[1:])]
+                      for c in record["contributors"]]
+
+            if "propriété" in variables and "role" in variables:
+                # Properties and contributors asked at once.
+                combined = [p + c for p in properties for c in people]
+            elif "role" in variables:
+                combined = [[None, None] + c for c in people]
+            else:
+                combined = [p + [None, None, None, None] for p in properties]
+
+            for p, v, role, fam, given, dude in combined:
+                row = {"link": link, "source": record["source"],
+                       "propriété": p, "valeur": v, "role": role,
+                       "dude": dude, "nomFamille": fam, "prénom": given}
+                rows.append({var: row.get(var) for var in variables})
+
+        return variables, rows
+
+    def person(self, uri):
+
+        """
+        Return the [family name, given name] of a person,
+        or None for an unknown URI.
+
+        :param uri: The URI of the person.
+
+        """
+
+        if uri in self.persons:
+            return self.persons[uri]
+        found = re.fullmatch(r"http://data\.bnf\.fr/ark:/12148/cb1"
+                             r"(\d{3})(\d{3})#about", uri)
+        if found is None:
+            return None
+        fam, given = int(found.group(1)), int(found.group(2))
+        if fam >= len(FAMILY_NAMES) or given >= len(GIVEN_NAMES):
+            return None
+        return [FAMILY_NAMES[fam], GIVEN_NAMES[given]]
+
+def person_uri(fam, given, uri=None):
+    # The URI of a recorded person, made up from its names if needed.
+    if uri is not None:
+        return uri
+    digest = hashlib.sha1(f"{fam}\n{given}".encode()).hexdigest()
+    return f"http://data.bnf.fr/ark:/12148/cb2{int(digest, 16) % 10**8}#about"
+
+def load_records(path):
+
+    """
+    Load recorded records from a Json file, mapping each link to
+    {"source": ..., "properties": [[p, v], ...],
+    "contributors": [[role, family name, given name(, URI)], ...]}.
+
+    :param path: The path to the Json file.
+
+    """
+
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+######################################################
+
+# ANSWER THE REQUESTS
+
+class Handler(BaseHTTPRequestHandler):
+
+    """
+    Answer SPARQL requests (GET or POST) for the FakeEndpoint of the server.
+
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.respond(parse_qs(urlsplit(self.path).query).get("query", [""])[0])
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.respond(parse_qs(body.decode()).get("query", [""])[0])
+
+    def respond(self, query):
+        endpoint = self.server.endpoint
+        with endpoint.lock:
+            endpoint.requests += 1
+
+        time.sleep(endpoint.latency + random.uniform(0, endpoint.jitter))
+
+        # Sometimes pretend to be overloaded.
+        if random.random() < endpoint.error_rate:
+            with endpoint.lock:
+                endpoint.errors += 1
+            self.send_response(random.choice([429, 503]))
+            if endpoint.retry_after is not None:
+                self.send_header("Retry-After", str(endpoint.retry_after))
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        variables, rows = endpoint.answer(query)
+        accept = self.headers.get("Accept", "")
+        if "text/csv" in accept:
+            content_type, body = "text/csv", to_csv(variables, rows)
+        elif "text/tab-separated-values" in accept:
+            content_type = "text/tab-separated-values"
+            body = to_tsv(variables, rows)
+        else:
+            content_type = "application/sparql-results+json"
+            body = to_json(variables, rows)
+        body = body.encode("utf-8")
+
+        self.send_response(200)
+        self.send_header("Content-Type", content_type + "; charset=utf-8")
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            body = gzip.compress(body)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def is_iri(value):
+    return value.startswith("http://") or value.startswith("https://")
+
+def to_json(variables, rows):
+
+    """
+    Write rows as SPARQL Json results.
+
+    :param variables: The list of variables.
+    :param rows: The list of rows, as dicts.
+
+    """
+
+    bindings = [
+        {var: {"type": "uri" if is_iri(value) else "literal", "value": value}
+         for var, value in row.items() if value is not None}
+        for row in rows]
+    return json.dumps({"head": {"vars": variables},
+                       "results": {"bindings": bindings}},
+                      ensure_ascii=False)
+
+def to_csv(variables, rows):
+
+    """
+    Write rows as SPARQL CSV results.
+
+    :param variables: The list of variables.
+    :param rows: The list of rows, as dicts.
+
+    """
+
+    out = io.StringIO()
+    writer = csv.writer(out, lineterminator="\r\n")
+    writer.writerow(variables)
+    for row in rows:
+        writer.writerow(["" if row[var] is None else row[var]
+                         for var in variables])
+    return out.getvalue()
+
+def to_tsv(variables, rows):
+
+    """
+    Write rows as SPARQL TSV results, with values in Turtle syntax.
+
+    :param variables: The list of variables.
+    :param rows: The list of rows, as dicts.
+
+    """
+
+    def term(value):
+        if value is None:
+            return ""
+        if is_iri(value):
+            return f"<{value}>"
+        escaped = (value.replace("\\", "\\\\").replace('"', '\\"')
+                   .replace("\t", "\\t").replace("\n", "\\n"))
+        return f'"{escaped}"'
+
+    lines = ["\t".join("?" + var for var in variables)]
+    for row in rows:
+        lines.append("\t".join(term(row[var]) for var in variables))
+    return "\n".join(lines) + "\n"
+
+######################################################
+
+# MEASURE THE THROUGHPUT OF PARSE_LIST
+
+# The fetch modes to compare: parse_list() arguments.
+MODES = {
+    "sequential": dict(batch_size=1, concurrency=1, max_concurrency=1),
+    "concurrent": dict(batch_size=1, concurrency=8, max_concurrency=8),
+    "batched": dict(batch_size=50, concurrency=4)
+}
+
+def benchmark(links=500, modes=None, **endpoint_options):
+
+    """
+    This function measures how many links per second parse_list()
+    harvests from a FakeEndpoint, in each fetch mode, without cache.
+    It returns a dict with the links per second of each mode.
+
+    :param links: The number of links in the list (half Gallica URLs,
+        half catalogue URLs).
+    :param modes: A dict of modes (name → parse_list() arguments),
+        by default MODES.
+    :param endpoint_options: Keyword arguments passed on to FakeEndpoint().
+
+    """
+
+    speeds = {}
+
+    with FakeEndpoint(**endpoint_options) as endpoint, \
+            tempfile.TemporaryDirectory() as tmp:
+
+        path = os.path.join(tmp, "links.txt")
+        with open(path, "w") as f:
+            for i in range(links):
+                if i % 2:
+                    f.write(f"https://gallica.bnf.fr/ark:/12148/bpt6k{i}\n")
+                else:
+                    f.write(f"https://catalogue.bnf.fr/ark:/12148/cb{i}\n")
+
+        # Only the harvest is timed: no outputs, no preview.
+        for name, options in (modes or MODES).items():
+            start = time.perf_counter()
+            parse_list(path, cache=None, journal=None, output=None,
+                       excel=None, preview=False, endpoint=endpoint.url,
+                       **options)
+            speeds[name] = links / (time.perf_counter() - start)
+
+    return speeds
+
+######################################################
+
+# COMMAND LINE
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    serve = commands.add_parser("serve", help="Answer queries until Ctrl+C.")
+    bench = commands.add_parser("bench", help="Measure parse_list() speed.")
+    bench.add_argument("--links", type=int, default=500)
+    for command in (serve, bench):
+        command.add_argument("--port", type=int, default=0 if command is bench
+                             else 8890)
+        command.add_argument("--latency", type=float, default=0.1)
+        command.add_argument("--jitter", type=float, default=0.0)
+        command.add_argument("--error-rate", type=float, default=0.0)
+        command.add_argument("--retry-after", type=float, default=None)
+        command.add_argument("--properties", type=int, default=12)
+        command.add_argument("--contributors", type=int, default=3)
+        command.add_argument("--value-length", type=int, default=0)
+        command.add_argument("--missing-rate", type=float, default=0.0)
+        command.add_argument("--recorded", default=None,
+                             help="A Json file of recorded records.")
+
+    args = vars(parser.parse_args(argv))
+    command = args.pop("command")
+    links = args.pop("links", None)
+
+    if command == "serve":
+        endpoint = FakeEndpoint(**args).start()
+        print(f"Fake SPARQL endpoint at {endpoint.url}")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            endpoint.stop()
+    else:
+        for name, speed in benchmark(links, **args).items():
+            print(f"{name:>12}: {speed:8.1f} links/s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+
+"""
+Harvest a list of BnF links from DataBnF and lay it out as a bibliography.
+
+The functions of utils.py, from a terminal, a shell script or cron.
+Nothing heavy (Pandas, python-docx...) is imported before a command
+needs it, so --help answers at once.
+
+From a terminal:
+    python gallica2biblio.py harvest iiif_list.txt
+    python gallica2biblio.py layout iiif_metadata.parquet -o biblio.docx
+    python gallica2biblio.py run iiif_list.txt -o biblio.docx -o biblio.bib
+    python gallica2biblio.py serve --port 8892
+    python gallica2biblio.py ingest databnf_*.nt.gz --store databnf.sqlite
+"""
+
+import argparse
+import sys
+
+######################################################
+
+# THE OPTIONS OF EACH COMMAND
+
+def harvest_options(command):
+    # The options of parse_list().
+    command.add_argument("links", help="A TXT file with one link per line.")
+    command.add_argument("--batch-size", type=int, default=50)
+    command.add_argument("--concurrency", type=int, default=4)
+    command.add_argument("--max-concurrency", type=int, default=None)
+    command.add_argument("--retries", type=int, default=5)
+    command.add_argument("--timeout", type=float, default=120)
+    command.add_argument("--endpoint", default="https://data.bnf.fr/sparql",
+                         help="Or local:PATH, for a store built by ingest.")
+    command.add_argument("--result-format", default="json",
+                         choices=["json", "csv", "tsv"])
+    command.add_argument("--full", action="store_true",
+                         help="Harvest every property (lean=False).")
+    command.add_argument("--cache", default="sparql_cache.sqlite")
+    command.add_argument("--no-cache", action="store_true")
+    command.add_argument("--refresh", action="store_true",
+                         help="Ignore the cached responses.")
+    command.add_argument("--journal", default="iiif_journal.jsonl")
+    command.add_argument("--no-journal", action="store_true")
+    command.add_argument("--resume", action="store_true")
+    command.add_argument("--incremental", action="store_true",
+                         help="Only query the links added since last run.")
+    command.add_argument("--max-age", type=float, default=None,
+                         help="Query again the links journaled longer ago "
+                         "(in seconds).")
+    command.add_argument("--preview", action="store_true",
+                         help="Print the table at the end.")
+
+def layout_options(command):
+    # The options of author_date().
+    command.add_argument("-o", "--output", action="append", default=None,
+                         help="A .docx, .html, .bib, .ris or .json file "
+                         "(may be repeated). Default: biblio.docx.")
+    command.add_argument("--workers", type=int, default=1,
+                         help="The number of processes (0 for one per core).")
+    command.add_argument("--no-streaming", action="store_true",
+                         help="Build the DOCX file with python-docx.")
+
+def harvest_args(args):
+    # The keyword arguments of parse_list().
+    return dict(
+        batch_size=args.batch_size, concurrency=args.concurrency,
+        max_concurrency=args.max_concurrency, retries=args.retries,
+        timeout=args.timeout, endpoint=args.endpoint,
+        result_format=args.result_format, lean=not args.full,
+        cache=None if args.no_cache else args.cache, refresh=args.refresh,
+        journal=None if args.no_journal else args.journal,
+        resume=args.resume, incremental=args.incremental,
+        max_age=args.max_age, preview=args.preview)
+
+def layout_args(args):
+    # The keyword arguments of author_date().
+    output = args.output or ["biblio.docx"]
+    return dict(output=output[0] if len(output) == 1 else output,
+                workers=args.workers or None,
+                streaming=not args.no_streaming)
+
+######################################################
+
+# RUN THE COMMANDS
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--metrics", default=None,
+                        help="Write the metrics of the run into this file "
+                        "(.json, or .prom for Prometheus).")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    harvest = commands.add_parser(
+        "harvest", help="Harvest the links into a table.")
+    harvest_options(harvest)
+    harvest.add_argument("--output", default="iiif_metadata.parquet",
+                         help="The table for the layout (.parquet or .arrow).")
+    harvest.add_argument("--excel", default="iiif_metadata.xlsx")
+    harvest.add_argument("--no-excel", action="store_true")
+
+    layout = commands.add_parser(
+        "layout", help="Lay out a harvested table as a bibliography.")
+    layout.add_argument("table", help="A .parquet, .arrow or .xlsx table.")
+    layout_options(layout)
+
+    run = commands.add_parser(
+        "run", help="Harvest the links and lay them out, in memory.")
+    harvest_options(run)
+    layout_options(run)
+
+    serve = commands.add_parser(
+        "serve", help="Run harvest and layout jobs sent over HTTP.")
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=8892)
+    serve.add_argument("--socket", default=None,
+                       help="Listen on this Unix socket instead of a port.")
+    serve.add_argument("--workers", type=int, default=2,
+                       help="The number of jobs running at the same time.")
+    serve.add_argument("--directory", default=None,
+                       help="Keep the outputs of the jobs there.")
+    serve.add_argument("--endpoint", default="https://data.bnf.fr/sparql")
+    serve.add_argument("--cache", default="sparql_cache.sqlite")
+
+    ingest = commands.add_parser(
+        "ingest", help="Build a local store from DataBnF dumps.")
+    ingest.add_argument("dumps", nargs="+",
+                        help="N-Triples or RDF/XML files (.gz, .bz2).")
+    ingest.add_argument("--store", default="databnf.sqlite")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "serve":
+        return serve_jobs(args)
+    if args.command == "ingest":
+        return ingest_dumps(args)
+
+    # Only now import the heavy modules.
+    from utils import Metrics, author_date, parse_list
+
+    metrics = Metrics(enabled=args.metrics is not None)
+
+    if args.command == "harvest":
+        parse_list(args.links, metrics=metrics, output=args.output,
+                   excel=None if args.no_excel else args.excel,
+                   **harvest_args(args))
+    elif args.command == "layout":
+        author_date(args.table, metrics=metrics, **layout_args(args))
+    else:
+        table = parse_list(args.links, metrics=metrics, output=None,
+                           excel=None, **harvest_args(args))
+        author_date(table, metrics=metrics, **layout_args(args))
+
+    if args.metrics is not None:
+        if args.metrics.endswith(".prom"):
+            metrics.write_prometheus(args.metrics)
+        else:
+            metrics.write_json(args.metrics)
+
+def serve_jobs(args):
+    # Run the service until Ctrl+C.
+    import time
+    from biblio_service import BiblioService
+
+    service = BiblioService(
+        endpoint=args.endpoint, cache=args.cache, workers=args.workers,
+        directory=args.directory, host=args.host, port=args.port,
+        socket=args.socket).start()
+    print(f"Gallica to bibliography service at {service.url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        service.stop()
+
+def ingest_dumps(args):
+    # Read the dumps into the local store, showing the triples read.
+    from tqdm.auto import tqdm
+    from local_store import LocalStore
+
+    with tqdm(unit=" triples") as progress:
+        LocalStore(args.store).ingest(
+            args.dumps, progress=lambda n: progress.update(n - progress.n))
+    print(f"Harvest with --endpoint local:{args.store}")
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,449 @@
+# -*- coding: utf-8 -*-
+
+"""
+A local copy of DataBnF, built from its RDF dumps, to harvest large link
+lists at disk speed, without the network.
+
+The dumps (N-Triples or RDF/XML, optionally gzip or bzip2 compressed) are
+read as a stream into a SQLite file, where each term is stored once and
+the triples are indexed by subject and by the reproductions of the
+manifestations (bnf-onto:OCR, rdae:P30016, rdar:electronicReproduction).
+The store answers the queries of utils.build_queries() and
+utils.resolve_names() with the same results as the endpoint.
+
+From a terminal:
+    python gallica2biblio.py ingest databnf_*.nt.gz --store databnf.sqlite
+    python gallica2biblio.py harvest iiif_list.txt --endpoint local:databnf.sqlite
+
+From Python:
+    LocalStore("databnf.sqlite").ingest(["databnf_editions.nt.gz"])
+    parse_list("iiif_list.txt", endpoint="local:databnf.sqlite", cache=None)
+"""
+
+import bz2
+import gzip
+import re
+import sqlite3
+import threading
+import xml.etree.ElementTree as ET
+
+from utils import TSV_ESCAPE, unescape_tsv, values
+
+######################################################
+
+# THE VOCABULARY OF THE QUERIES
+
+RDF = "http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+RDF_TYPE = RDF + "type"
+FOAF = "http://xmlns.com/foaf/0.1/"
+PERSON = FOAF + "Person"
+FAMILY_NAME = FOAF + "familyName"
+GIVEN_NAME = FOAF + "givenName"
+EXPRESSION_MANIFESTED = \
+    "http://rdvocab.info/RDARelationshipsWEMI/expressionManifested"
+
+# The properties linking a manifestation to its Gallica reproductions,
+# as in utils.LINK_PATTERNS.
+REPRODUCTIONS = [
+    "http://data.bnf.fr/ontology/bnf-onto/OCR",
+    "http://rdaregistry.info/Elements/m/P30016",
+    "http://rdvocab.info/RDARelationshipsWEMI/electronicReproduction"
+]
+
+# SQLite takes a limited number of parameters per statement.
+CHUNK = 500
+
+######################################################
+
+# READ THE DUMPS
+
+# A line of an N-Triples file: subject, predicate, object.
+NT_LINE = re.compile(
+    r'^\s*(<[^>]*>|_:\S+)\s+<([^>]*)>\s+'
+    r'(<[^>]*>|_:\S+|"(?:[^"\\]|\\.)*"(?:@[\w-]+|\^\^<[^>]*>)?)\s*\.\s*$')
+
+# An escape sequence in an N-Triples literal, as in the TSV results.
+NT_ESCAPE = re.compile(TSV_ESCAPE)
+
+def open_dump(path, mode="rt"):
+    # Open a dump, compressed or not, as text or bytes.
+    encoding = None if "b" in mode else "utf-8"
+    if path.endswith(".gz"):
+        return gzip.open(path, mode, encoding=encoding)
+    if path.endswith(".bz2"):
+        return bz2.open(path, mode, encoding=encoding)
+    return open(path, mode, encoding=encoding)
+
+def read_ntriples(path, bnodes=""):
+
+    """
+    This generator reads an N-Triples file line by line and yields
+    its triples as (subject, predicate, object) strings, with IRIs
+    and literals as their bare value, as SPARQL results give them.
+
+    :param path: The path to the file (.nt, .nt.gz or .nt.bz2).
+    :param bnodes: A prefix making the blank nodes of the file unique.
+
+    """
+
+    with open_dump(path) as f:
+        for line in f:
+            found = NT_LINE.match(line)
+            if found is None:
+                continue
+            s, p, o = found.groups()
+            yield term(s, bnodes), p, term(o, bnodes)
+
+def term(text, bnodes=""):
+    # The value of an N-Triples term.
+    if text[0] == "<":
+        return text[1:-1]
+    if text[0] == "_":
+        return "_:" + bnodes + text[2:]
+    return NT_ESCAPE.sub(unescape_tsv, text[1:text.rindex('"')])
+
+def read_rdfxml(path, bnodes=""):
+
+    """
+    This generator reads an RDF/XML file as a stream and yields its
+    triples as (subject, predicate, object) strings. Only the striped
+    syntax of the DataBnF dumps is read: descriptions (rdf:Description
+    or typed nodes) with rdf:about or rdf:nodeID, whose properties hold
+    a literal, an rdf:resource, an rdf:nodeID or a nested description.
+
+    :param path: The path to the file (.rdf, .xml or .owl, possibly
+        followed by .gz or .bz2).
+    :param bnodes: A prefix making the blank nodes of the file unique.
+
+    """
+
+    counter = iter(range(1 << 62))
+
+    def name(tag):
+        # {namespace}local → namespacelocal
+        return tag[1:].replace("}", "", 1) if tag[0] == "{" else tag
+
+    def node(element):
+        # The subject of a description, and its triples.
+        about = element.get(f"{{{RDF}}}about")
+        if about is None:
+            label = element.get(f"{{{RDF}}}nodeID") or f"x{next(counter)}"
+            about = "_:" + bnodes + label
+        triples = []
+        if element.tag != f"{{{RDF}}}Description":
+            triples.append((about, RDF_TYPE, name(element.tag)))
+        for prop in element:
+            predicate = name(prop.tag)
+            resource = prop.get(f"{{{RDF}}}resource")
+            node_id = prop.get(f"{{{RDF}}}nodeID")
+            if resource is not None:
+                triples.append((about, predicate, resource))
+            elif node_id is not None:
+                triples.append((about, predicate, "_:" + bnodes + node_id))
+            elif len(prop) != 0:
+                nested, more = node(prop[0])
+                triples.append((about, predicate, nested))
+                triples.extend(more)
+            else:
+                triples.append((about, predicate, prop.text or ""))
+        return about, triples
+
+    with open_dump(path, "rb") as f:
+        depth = 0
+        root = None
+        for event, element in ET.iterparse(f, ("start", "end")):
+            if event == "start":
+                if root is None:
+                    root = element
+                depth += 1
+                continue
+            depth -= 1
+            # The descriptions are the children of rdf:RDF, which
+            # would keep them all: let go of each one once read.
+            if depth == 1:
+                yield from node(element)[1]
+                root.clear()
+
+def read_dump(path, bnodes=""):
+    # Read a dump according to its extension.
+    base = re.sub(r"\.(gz|bz2)$", "", path)
+    if base.endswith((".rdf", ".xml", ".owl")):
+        return read_rdfxml(path, bnodes)
+    return read_ntriples(path, bnodes)
+
+######################################################
+
+# THE STORE
+
+class LocalStore:
+
+    """
+    A local, indexed copy of DataBnF in a SQLite file.
+
+    Terms (IRIs and literals) are stored once, with an id. Triples are
+    stored as ids, sorted by subject, and the Gallica reproductions of
+    the manifestations are also stored by reproduction, so that both
+    lookups of parse_list() (by manifestation and by Gallica link)
+    read a few pages of the file.
+
+    The store may be read by several threads at once: each one
+    gets its own connection, reading the file through a memory map.
+
+    :param path: The path to the SQLite file (created if needed).
+    :param mmap_size: The number of bytes of the file to map in memory.
+
+    """
+
+    def __init__(self, path="databnf.sqlite", mmap_size=1 << 30):
+        self.path = path
+        self.mmap_size = mmap_size
+        self.local = threading.local()
+
+        db = self.connect()
+        db.executescript("""
+            CREATE TABLE IF NOT EXISTS terms (
+                id INTEGER PRIMARY KEY,
+                value TEXT UNIQUE);
+            CREATE TABLE IF NOT EXISTS triples (
+                s INTEGER, p INTEGER, o INTEGER,
+                PRIMARY KEY (s, p, o)) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS reproductions (
+                link INTEGER, source INTEGER,
+                PRIMARY KEY (link, source)) WITHOUT ROWID;""")
+        db.commit()
+
+    def connect(self):
+        # The connection of the current thread.
+        db = getattr(self.local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path)
+            db.execute(f"PRAGMA mmap_size = {int(self.mmap_size)}")
+            self.local.db = db
+        return db
+
+    def ingest(self, paths, batch_size=100000, max_terms=1000000,
+               progress=None):
+
+        """
+        Read dumps into the store, and return the number of triples read.
+        Triples already in the store are not stored twice.
+
+        :param paths: The paths to the dumps (see read_dump()).
+        :param batch_size: The number of triples written at a time.
+        :param max_terms: The number of term ids kept in memory
+            while reading, to avoid looking them up in the file.
+        :param progress: A function called with the number of triples
+            read so far after each batch, or None.
+
+        """
+
+        db = self.connect()
+        db.execute("PRAGMA journal_mode = OFF")
+        db.execute("PRAGMA synchronous = OFF")
+
+        next_id = db.execute(
+            "SELECT COALESCE(MAX(id), 0) + 1 FROM terms").fetchone()[0]
+        ids = {}
+        new_terms = []
+
+        def term_id(value):
+            nonlocal next_id
+            i = ids.get(value)
+            if i is None:
+                found = db.execute(
+                    "SELECT id FROM terms WHERE value = ?", (value,)).fetchone()
+                if found is None:
+                    i = next_id
+                    next_id += 1
+                    new_terms.append((i, value))
+                else:
+                    i = found[0]
+                ids[value] = i
+            return i
+
+        reproductions = {term_id(p) for p in REPRODUCTIONS}
+        triples = []
+        n = 0
+
+        def flush():
+            db.executemany("INSERT INTO terms VALUES (?, ?)", new_terms)
+            db.executemany("INSERT OR IGNORE INTO triples VALUES (?, ?, ?)",
+                           triples)
+            db.executemany("INSERT OR IGNORE INTO reproductions VALUES (?, ?)",
+                           [(o, s) for s, p, o in triples
+                            if p in reproductions])
+            db.commit()
+            new_terms.clear()
+            triples.clear()
+            # Forget the ids once there are too many: they are in the file.
+            if len(ids) > max_terms:
+                ids.clear()
+
+        # Blank nodes are only unique within their file.
+        for idx, path in enumerate(paths):
+            for s, p, o in read_dump(path, bnodes=f"{idx}."):
+                triples.append((term_id(s), term_id(p), term_id(o)))
+                n += 1
+                if len(triples) == batch_size:
+                    flush()
+                    if progress is not None:
+                        progress(n)
+        flush()
+        if progress is not None:
+            progress(n)
+
+        db.execute("PRAGMA journal_mode = DELETE")
+        db.execute("ANALYZE")
+        db.commit()
+        return n
+
+    ######################################################
+
+    # ANSWER THE QUERIES
+
+    def ids(self, values):
+        # The ids of the known terms, by value.
+        values = list(values)
+        found = {}
+        for i in range(0, len(values), CHUNK):
+            chunk = values[i:i + CHUNK]
+            found.update((v, i) for i, v in self.connect().execute(
+                "SELECT id, value FROM terms WHERE value IN (%s)"
+                % ", ".join("?" * len(chunk)), chunk))
+        return found
+
+    def values(self, ids):
+        # The values of terms, by id.
+        ids = list(set(ids))
+        found = {}
+        for i in range(0, len(ids), CHUNK):
+            chunk = ids[i:i + CHUNK]
+            found.update(self.connect().execute(
+                "SELECT id, value FROM terms WHERE id IN (%s)"
+                % ", ".join("?" * len(chunk)), chunk))
+        return found
+
+    def triples(self, subjects, predicates=None):
+        # The (s, p, o) triples of subjects, for some predicates or all.
+        subjects = list(set(subjects))
+        where = ""
+        extra = []
+        if predicates is not None:
+            predicates = list(predicates)
+            if len(predicates) == 0:
+                return []
+            where = " AND p IN (%s)" % ", ".join("?" * len(predicates))
+            extra = predicates
+        rows = []
+        for i in range(0, len(subjects), CHUNK):
+            chunk = subjects[i:i + CHUNK]
+            rows.extend(self.connect().execute(
+                "SELECT s, p, o FROM triples WHERE s IN (%s)%s"
+                % (", ".join("?" * len(chunk)), where), chunk + extra))
+        return rows
+
+    def sources(self, links, gallica):
+        # The manifestations of each link: the Gallica reproductions
+        # are looked up, the ARK URIs are manifestations themselves.
+        if not gallica:
+            return {link: [link] for link in links}
+        sources = {link: [] for link in links}
+        links = list(links)
+        for i in range(0, len(links), CHUNK):
+            chunk = links[i:i + CHUNK]
+            for link, source in self.connect().execute(
+                    "SELECT link, source FROM reproductions WHERE link IN (%s)"
+                    % ", ".join("?" * len(chunk)), chunk):
+                sources[link].append(source)
+        return sources
+
+    def answer(self, query):
+
+        """
+        Answer a query built by utils.build_queries() or
+        utils.resolve_names(), and return its results as
+        utils.read_json_results() does: the variables of the query,
+        and a column of values for each of them.
+
+        :param query: A string containing the query.
+
+        """
+
+        select = re.search(r"SELECT\s+(?:DISTINCT\s+)?(.*?)\s+WHERE",
+                           query, re.S)
+        variables = re.findall(r"\?(\w+)", select.group(1)) if select else []
+        links = values(query, "link") or []
+        wanted = values(query, "propriété")
+
+        known = self.ids(links + REPRODUCTIONS + [
+            RDF_TYPE, PERSON, FAMILY_NAME, GIVEN_NAME, EXPRESSION_MANIFESTED]
+            + (wanted or []))
+        link_ids = [known[link] for link in links if link in known]
+
+        if "valeur" in variables:
+            rows = self.properties(query, link_ids, known, wanted)
+        elif "role" in variables:
+            rows = self.contributors(query, link_ids, known)
+        elif "nomFamille" in variables:
+            rows = self.names(link_ids, known)
+        else:
+            raise ValueError("The local store does not know this query.")
+
+        # SELECT DISTINCT, with the values of the terms.
+        rows = list(dict.fromkeys(rows))
+        terms = self.values(i for row in rows for i in row)
+        columns = {var: [terms[row[k]] for row in rows]
+                   for k, var in enumerate(variables)}
+        return {"vars": variables, "columns": columns}
+
+    def manifestations(self, query, link_ids, known):
+        # The (link, source) pairs of the links which
+        # are manifestations of an expression, with it.
+        em = known.get(EXPRESSION_MANIFESTED)
+        sources = self.sources(link_ids, "BIND" not in query)
+        expressions = {}
+        for s, p, o in self.triples(
+                [s for ss in sources.values() for s in ss],
+                [em] if em is not None else []):
+            expressions.setdefault(s, []).append(o)
+        return [(link, source, expressions[source])
+                for link, ss in sources.items() for source in ss
+                if source in expressions]
+
+    def properties(self, query, link_ids, known, wanted):
+        # ?link ?source ?propriété ?valeur
+        found = self.manifestations(query, link_ids, known)
+        predicates = None
+        if wanted is not None:
+            predicates = [known[p] for p in wanted if p in known]
+        props = {}
+        for s, p, o in self.triples([s for _, s, _ in found], predicates):
+            props.setdefault(s, []).append((p, o))
+        return [(link, source, p, o) for link, source, _ in found
+                for p, o in props.get(source, [])]
+
+    def contributors(self, query, link_ids, known):
+        # ?link ?source ?role ?dude, for the dudes who are persons.
+        found = self.manifestations(query, link_ids, known)
+        roles = {}
+        for s, p, o in self.triples(
+                [e for _, _, expressions in found for e in expressions]):
+            roles.setdefault(s, []).append((p, o))
+        dudes = {o for pairs in roles.values() for _, o in pairs}
+        person = known.get(PERSON)
+        persons = {s for s, p, o in self.triples(
+            dudes, [known[RDF_TYPE]] if RDF_TYPE in known else [])
+            if o == person}
+        return [(link, source, p, o) for link, source, expressions in found
+                for e in expressions for p, o in roles.get(e, [])
+                if o in persons]
+
+    def names(self, link_ids, known):
+        # ?link ?nomFamille ?prénom, for each pair of names.
+        fam, given = known.get(FAMILY_NAME), known.get(GIVEN_NAME)
+        names = {}
+        for s, p, o in self.triples(
+                link_ids, [i for i in (fam, given) if i is not None]):
+            names.setdefault(s, {fam: [], given: []})[p].append(o)
+        return [(s, f, g) for s, found in names.items()
+                for f in found[fam] for g in found[given]]
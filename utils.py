@@ -1,166 +1,1963 @@
 # -*- coding: utf-8 -*-
 
+import asyncio
+import codecs
+import csv
+import hashlib
+import html
+import http.client
+import json
+import os
+import queue
+import random
+import re
+import sqlite3
+import string
+import threading
+import time
+import tracemalloc
+import zipfile
+import zlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from itertools import islice
+from email.utils import parsedate_to_datetime
+from urllib.error import HTTPError
+from urllib.parse import urlencode, urlsplit
+from xml.sax.saxutils import escape as xml_escape
+
 import numpy as np
 import pandas as pd
-from docx import Document
-from SPARQLWrapper import SPARQLWrapper, JSON
-from tqdm.notebook import tqdm
+
+# python-docx and tqdm are only imported when they are needed,
+# so that the command line starts quickly (see gallica2biblio.py).
+
+######################################################
+
+# QUERY TEMPLATES
+
+# Each batch of links is harvested with two queries: one for the
+# properties of the manifestations, one for their contributors.
+# Asking for both at once would return every property once per
+# contributor. The results are put back together by reorder().
+
+# Contributors are only harvested as URIs: the names of each person
+# are asked once, with NAMES_QUERY, and kept in the cache (see
+# resolve_names()), as the same authors come back in many records.
+
+# All templates select the queried link as ?link, so that the
+# results of a batched query can be split back per link.
+# The first "%s" placeholder receives the content of the VALUES block,
+# the second one the pattern linking ?link to the manifestation ?source.
+# The third one, in the properties query, may restrict the properties.
+
+PREFIXES = """
+    PREFIX rdae: <http://rdaregistry.info/Elements/m/>
+    PREFIX bnf-onto: <http://data.bnf.fr/ontology/bnf-onto/>
+    PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
+    PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
+    PREFIX foaf: <http://xmlns.com/foaf/0.1/>
+    PREFIX rdar: <http://rdvocab.info/RDARelationshipsWEMI/>
+    """
+
+# The properties of the manifestations.
+PROPERTIES_QUERY = PREFIXES + """
+    SELECT DISTINCT ?link ?source ?propriété ?valeur
+    
+    WHERE {
+        VALUES ?link { %s }
+        %s
+        %s
+        ?source ?propriété ?valeur ;
+      		  rdar:expressionManifested ?expression.
+    }"""
+
+# The contributors of the manifestations, with their roles.
+CONTRIBUTORS_QUERY = PREFIXES + """
+    SELECT DISTINCT ?link ?source ?role ?dude
+    
+    WHERE {
+        VALUES ?link { %s }
+        %s
+        ?source rdar:expressionManifested ?expression.
+    	?expression ?role ?dude .
+        ?dude a foaf:Person .
+    }"""
+
+# The names of persons. Here, ?link is the URI of each person.
+NAMES_QUERY = PREFIXES + """
+    SELECT DISTINCT ?link ?nomFamille ?prénom
+    
+    WHERE {
+        VALUES ?link { %s }
+        ?link foaf:familyName ?nomFamille ;
+              foaf:givenName ?prénom.
+    }"""
+
+LINK_PATTERNS = {
+    # For Gallica reproductions: find the manifestation(s) which
+    # have the Gallica URL as a digital reproduction.
+    "gallica": "?source bnf-onto:OCR|rdae:P30016|rdar:electronicReproduction ?link .",
+    # For ARK URIs: the DataBnF URI is the manifestation itself.
+    "ark": "BIND ( ?link as ?source)"
+}
+
+def build_queries(kind, links, lean=True):
+
+    """
+    This function assembles the SPARQL queries for a batch of links
+    of the same kind, using a VALUES block.
+
+    :param kind: "gallica" for Gallica URLs, "ark" for DataBnF URIs.
+    :param links: A list of strings containing the links to query.
+    :param lean: If True, only ask for the properties which reorder()
+        sorts into its columns. If False, ask for every property,
+        to fill the "Other" column too.
+    
+    """
+
+    values = " ".join(f"<{link}>" for link in links)
+    return [
+        PROPERTIES_QUERY % (values, LINK_PATTERNS[kind],
+                            LEAN_PROPERTIES if lean else ""),
+        CONTRIBUTORS_QUERY % (values, LINK_PATTERNS[kind])
+    ]
+
+def values(query, var):
+
+    """
+    Return the IRIs of the VALUES block of a variable in a query,
+    or None if there is none.
+
+    :param query: A string containing a SPARQL query.
+    :param var: The name of the variable.
+    
+    """
+
+    block = re.search(r"VALUES\s+\?" + var + r"\s*\{([^}]*)\}", query)
+    if block is None:
+        return None
+    return re.findall(r"<([^>]*)>", block.group(1))
 
 ######################################################
 
 # WRITE, SEND AND AGGREGATE THE QUERIES
 
-def parse_list(iiif_list):
+def parse_list(iiif_list, batch_size=50, concurrency=4,
+               cache="sparql_cache.sqlite", refresh=False, pool_size=None,
+               journal="iiif_journal.jsonl", resume=False, incremental=False,
+               max_age=None, chunk_size=1000,
+               result_format="json", lean=True, max_concurrency=None,
+               retries=5, timeout=120, endpoint="https://data.bnf.fr/sparql",
+               metrics=None, output="iiif_metadata.parquet",
+               excel="iiif_metadata.xlsx", dictionary=None, preview=True):
     """
     This function takes a list of URLs/URIs as a TXT file
     with one URL/URI per line. Anything which does not
     contain bnf.fr will simply be ignored.
 
-    The output is a human-readable XLSX file with all information sorted.
+    The links are sent to DataBnF in batches: one query
+    holds up to batch_size links of the same kind.
+
+    The output is a table with all information sorted, returned as
+    a Pandas DataFrame to be given to author_date(). It is also written
+    into a Parquet or Arrow file, and into a human-readable XLSX file.
 
     :param iiif_list: The path to the TXT file containing the URL/URI list.
+    :param batch_size: The maximum number of links per query
+        (1 sends one query per link).
+    :param concurrency: The number of queries waiting on DataBnF
+        at the same time at first. It grows while DataBnF answers well,
+        and is halved when it struggles (errors, 429, 503, timeouts).
+    :param cache: The path to the SQLite response cache, a QueryCache,
+        or None to bypass the cache entirely.
+    :param refresh: If True, ignore cached responses but store
+        the new ones.
+    :param pool_size: The number of keep-alive connections to DataBnF
+        (by default, one per concurrent query at most).
+    :param journal: The path to the journal where the results of each
+        link are appended as soon as they arrive, or None for no journal.
+    :param resume: If True, skip the links already in the journal
+        and reuse their results (e.g. after a crash).
+    :param incremental: If True, the journal of the previous run is
+        its manifest: only the links added to the list since then are
+        queried, and the links removed from it are dropped from the
+        journal and the table.
+    :param max_age: The number of seconds after which the journaled
+        results of a link are queried again, or None to keep them.
+        Their queries skip the cached responses, as with refresh.
+        Links whose new query fails keep their journaled results.
+    :param chunk_size: The number of lines read from the file at a time.
+        The first batches are sent while the rest of the file is read.
+    :param result_format: The format of the results sent by DataBnF:
+        "json", or the more compact "csv" or "tsv".
+    :param lean: If True, only harvest the properties sorted into
+        the columns of the table, leaving the "Other" column empty.
+        Use False to keep the "Other" column.
+    :param max_concurrency: The maximum number of queries waiting
+        on DataBnF at the same time (by default, 4 × concurrency).
+    :param retries: The number of times a failed query is sent again,
+        after an exponential and random delay, before its links are
+        reported as failed at the end of the run.
+    :param timeout: The number of seconds to wait for DataBnF.
+    :param endpoint: A string containing the URL for the SPARQL endpoint
+        (e.g. a local fake_endpoint.FakeEndpoint).
+    :param metrics: A Metrics object recording the time spent in each
+        stage of the run, or None.
+    :param output: The path to the table for a later author_date():
+        a .parquet or .arrow file (which needs pyarrow: without it,
+        only the XLSX export is written), or None.
+    :param excel: The path to the human-readable XLSX export, or None.
+    :param dictionary: The columns of the output to dictionary-encode
+        (True for all, False for none, None for DICTIONARY_COLUMNS).
+    :param preview: If True, show the table at the end of the run.
     
     """
 
-    # Initiate the base list.
-    all_dfs = []
+    if metrics is None:
+        metrics = NO_METRICS
+
+    # Make sure the table can be written before harvesting anything:
+    # without pyarrow, the XLSX export is the table for the layout.
+    if output is not None and table_format(output) != "xlsx":
+        try:
+            import_pyarrow()
+        except ImportError:
+            if excel is None:
+                raise
+            print(f"pyarrow is not installed: {output} will not be "
+                  f"written, lay out {excel} instead.")
+            output = None
+
+    metrics.start()
+
+    # Get the results of an interrupted or previous run,
+    # and those which are too old to be kept.
+    done = {}
+    stale = {}
+    if incremental and journal is None:
+        raise ValueError("An incremental run needs a journal.")
+    if journal is not None and (resume or incremental):
+        done = read_journal(journal, max_age, stale)
+
+    # Open the response cache, if any.
+    if isinstance(cache, str):
+        cache = QueryCache(cache)
+
+    # The links of the batches sent but not answered yet,
+    # and the original lines of each link.
+    pending = {}
+    lines = {}
+
+    # The queries of the stale links, which must reach DataBnF
+    # rather than the responses cached when they were journaled.
+    refreshed = set()
+
+    def queries():
+        # Assemble the query with the links of each batch,
+        # as the batches are read from the file.
+        batches = metrics.timed(
+            iter_batches(iiif_list, batch_size, chunk_size, done, lines,
+                         stale),
+            "link parsing")
+        for i, (kind, batch) in enumerate(batches):
+            pending[i] = batch
+            with metrics.stage("query build"):
+                built = build_queries(kind, batch, lean)
+            # Stale links are batched apart from the others.
+            if batch[0] in stale:
+                refreshed.update(built)
+            yield built
+
+    def answered(i, df, jf=None):
+        # Journal the links of each batch as soon as it is answered.
+        batch = pending.pop(i)
+        metrics.rows(batch, df)
+        if jf is not None:
+            with metrics.stage("journal"):
+                write_journal(jf, batch, df)
+
+    # The links whose queries failed, with the error.
+    failed = {}
+
+    def failure(i, error):
+        # They are not journaled, so a resumed run tries them again.
+        for link in pending.pop(i):
+            failed[link] = error
+
+    # Send the queries to the SPARQL endpoint and
+    # transform the Json results into Pandas DataFrames,
+    # with the ?link of each result as its source.
+    max_concurrency = max_concurrency or 4 * concurrency
+    options = dict(
+        concurrency=concurrency, max_concurrency=max_concurrency,
+        retries=retries, on_failure=failure, result_format=result_format,
+        cache=cache, refresh=refresh or refreshed, metrics=metrics,
+        pool=get_pool(endpoint, pool_size or max_concurrency, timeout))
+
+    if journal is None:
+        all_dfs = fetch_all(queries(), endpoint, on_result=answered, **options)
+    else:
+        # A new run starts a new journal, a resumed one goes on with it.
+        mode = "a" if resume or incremental else "w"
+        with open(journal, mode, encoding="utf-8") as jf:
+            all_dfs = fetch_all(queries(), endpoint,
+                                on_result=partial(answered, jf=jf), **options)
+
+    # Keep the old results of the links which could not be harvested again.
+    for link in failed:
+        if link in stale:
+            done[link] = stale[link]
+
+    # Only keep the journaled links which are still in the list.
+    if incremental:
+        with metrics.stage("journal"):
+            compact_journal(journal, lines)
+
+    # Add the results of the links journaled by a previous run.
+    done_rows = [row for link, rows in done.items() if link in lines
+                 for row in rows]
+    if len(done_rows) != 0:
+        all_dfs.append(pd.DataFrame(done_rows, dtype=object))
+
+    # Assemble all DataFrames into one, even if nothing came back.
+    with metrics.stage("pd.concat"):
+        all_dfs = [df for df in all_dfs if df is not None]
+        if len(all_dfs) != 0:
+            all_results = pd.concat(all_dfs)
+        else:
+            all_results = pd.DataFrame(columns=["Source"], dtype=object)
+
+    # Get the names of the contributors, once per person.
+    names = None
+    unnamed = {}
+    if "dude" in all_results:
+        names = resolve_names(
+            all_results["dude"].dropna().unique(), endpoint,
+            cache=cache, refresh=refresh, batch_size=batch_size,
+            concurrency=concurrency, max_concurrency=max_concurrency,
+            retries=retries, result_format=result_format, metrics=metrics,
+            pool=options["pool"],
+            on_failure=lambda uris, error: unnamed.update(
+                dict.fromkeys(uris, error)))
+
+    # The links of the persons who could not be named are
+    # reported too: they are named by their URI in the table.
+    if len(unnamed) != 0:
+        people = all_results[all_results["dude"].isin(list(unnamed))]
+        for link, dude in zip(people["Source"], people["dude"]):
+            failed.setdefault(link, unnamed[dude])
+
+    # Report the links which could not be harvested.
+    if len(failed) != 0:
+        print(f"{len(failed)} link(s) could not be harvested:")
+        for link, error in failed.items():
+            for l in lines[link]:
+                print(f"{l} → {error!r}")
+
+    # Fan the results of each link back out to its original lines.
+    with metrics.stage("fan out"):
+        sources = pd.DataFrame(
+            [(link, l) for link, ls in lines.items() for l in ls],
+            columns=["Source", "line"])
+        all_results = all_results.merge(sources, on="Source").drop(
+            columns="Source").rename(columns={"line": "Source"})
+
+    # Reorder the DataFrame to have one line per book and show it.
+    with metrics.stage("reorder"):
+        final = pd.DataFrame(reorder(all_results, names))
+    if preview:
+        show(final)
+
+    # Write the resulting DataFrame for the layout, and for humans.
+    if output is not None:
+        with metrics.stage("write " + table_format(output)):
+            write_table(final, output, dictionary)
+    if excel is not None:
+        with metrics.stage("to_excel"):
+            write_table(final, excel)
+
+    metrics.stop()
+
+    return final
+
+def show(df):
+
+    """
+    This function displays a DataFrame in a notebook,
+    and prints it anywhere else.
+
+    :param df: A Pandas DataFrame.
+    
+    """
+
+    try:
+        display(df)
+    except NameError:
+        print(df)
+
+######################################################
+
+# NAME THE CONTRIBUTORS
+
+def resolve_names(uris, endpoint, cache=None, refresh=False, batch_size=50,
+                  on_failure=None, **options):
+
+    """
+    This function gets the family and given names of persons from
+    their URIs, and returns them as a Pandas DataFrame with the
+    "dude", "nomFamille" and "prénom" columns reorder() joins.
+    Persons already in the cache are not asked again; the others
+    are asked in batches of batch_size URIs.
+
+    Persons whose query failed for good are named by their URI
+    (with an empty given name), so that their works are not left out.
+
+    :param uris: The URIs of the persons.
+    :param endpoint: A string containing the URL for the SPARQL endpoint.
+    :param cache: A QueryCache keeping the names, or None.
+    :param refresh: If True, ask again for every person.
+    :param batch_size: The maximum number of persons per query.
+    :param on_failure: A function called with the URIs of each
+        query which failed for good, and the last error.
+    :param options: Keyword arguments passed on to fetch_all().
+    
+    """
+
+    uris = list(uris)
+    known = {}
+    if cache is not None and not refresh:
+        known = cache.get_names(uris, endpoint)
+    unknown = [uri for uri in uris if uri not in known]
+
+    batches = [unknown[i:i + batch_size]
+               for i in range(0, len(unknown), batch_size)]
+    queries = (NAMES_QUERY % " ".join(f"<{uri}>" for uri in batch)
+               for batch in batches)
+
+    # The persons of the failed queries are not cached,
+    # so that they are asked again next time.
+    failed = {}
+    def failure(i, error):
+        failed[i] = error
+        if on_failure is not None:
+            on_failure(batches[i], error)
+
+    dfs = fetch_all(queries, endpoint, cache=None, on_failure=failure,
+                    **options)
+
+    found = {}
+    for i, (batch, df) in enumerate(zip(batches, dfs)):
+        if i in failed:
+            known.update((uri, [[uri, ""]]) for uri in batch)
+            continue
+        # Persons without names are cached too, with no names.
+        found.update((uri, []) for uri in batch)
+        if df is not None:
+            for uri, fam, given in zip(df["Source"], df["nomFamille"],
+                                       df["prénom"]):
+                found[uri].append([fam, given])
+    if cache is not None and len(found) != 0:
+        cache.put_names(found, endpoint)
+    known.update(found)
+
+    return pd.DataFrame(
+        [(uri, fam, given) for uri, names in known.items()
+         for fam, given in names],
+        columns=["dude", "nomFamille", "prénom"], dtype=object)
+
+######################################################
+
+# READ THE LINKS LAZILY
+
+def read_links(iiif_list, chunk_size=1000):
+
+    """
+    This generator reads the list of URLs/URIs lazily and yields
+    its lines in chunks, so that the whole file is never held in memory.
+
+    :param iiif_list: The path to the TXT file containing the URL/URI list.
+    :param chunk_size: The maximum number of lines per chunk.
+    
+    """
 
-    # Get the URI/URL list from the file.
     with open(iiif_list) as f:
-        texte = f.read()
+        while True:
+            chunk = [l.strip() for l in islice(f, chunk_size)]
+            if len(chunk) == 0:
+                break
+            yield chunk
+
+# Any BnF URL holding an ARK identifier: Gallica (with or without
+# a page or view, e.g. /f12.image, .item, .texteImage), the catalogue,
+# ark.bnf.fr or DataBnF, over http or https.
+ARK_URL = re.compile(
+    r"https?://(?:[\w-]+\.)*bnf\.fr/(?:\S*?/)?ark:/12148/([a-z0-9]+)",
+    re.IGNORECASE)
+
+def normalize_link(l):
+
+    """
+    This function extracts the canonical ark:/12148/... identifier
+    from any form of BnF URL and tells which query it needs.
+    It returns a tuple with the kind of query and the link to query,
+    or None if the line is not a URL/URI we can use.
+
+    :param l: A line of the URL/URI list.
     
-    links = texte.split("\n")
+    """
+
+    found = ARK_URL.search(l)
+    if found is None:
+        return None
 
-    # For each line in the file.
-    for l in tqdm(links):
+    name = found.group(1).lower()
 
-        # If it is a Gallica URL:
-        
-        if "http://gallica.bnf.fr" in l:
+    # Catalogue records (cb...) are manifestations:
+    # query the corresponding DataBnF URI.
+    if name.startswith("cb"):
+        return "ark", f"http://data.bnf.fr/ark:/12148/{name}#about"
 
-            # Define the main parts of the query.
-            
-            # Beginning of the query.
-            qb = """
-    PREFIX rdae: <http://rdaregistry.info/Elements/m/>
-    PREFIX bnf-onto: <http://data.bnf.fr/ontology/bnf-onto/>
-    PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
-    PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
-    PREFIX foaf: <http://xmlns.com/foaf/0.1/>
-    PREFIX rdar: <http://rdvocab.info/RDARelationshipsWEMI/>
+    # Anything else is a Gallica document.
+    return "gallica", f"http://gallica.bnf.fr/ark:/12148/{name}"
+
+def iter_batches(iiif_list, batch_size=50, chunk_size=1000, done=(),
+                 lines=None, stale=()):
+
+    """
+    This generator reads the URL/URI list chunk by chunk, and yields
+    (kind, links) batches of up to batch_size links as soon as they are full.
+    Lines which point to the same document are only queried once.
+
+    :param iiif_list: The path to the TXT file containing the URL/URI list.
+    :param batch_size: The maximum number of links per batch.
+    :param chunk_size: The number of lines read from the file at a time.
+    :param done: The links which do not need to be queried again.
+    :param lines: A dict filled with each normalized link and
+        the list of original lines pointing to it.
+    :param stale: The links queried again, batched apart from the others.
     
-    SELECT DISTINCT ?source ?propriété ?valeur ?role ?nomFamille ?prénom
+    """
+
+    # The links waiting for a batch, by kind and staleness.
+    to_query = {(kind, old): [] for kind in ("gallica", "ark")
+                for old in (False, True)}
+    if lines is None:
+        lines = {}
+
+    for chunk in read_links(iiif_list, chunk_size):
+
+        # Sort each line according to the query it needs.
+        for l in chunk:
+            normalized = normalize_link(l)
+            if normalized is None:
+                print(f"{l} is not a URL/URI we can use for now.")
+                continue
+
+            # Only query each document once.
+            kind, link = normalized
+            if link in lines:
+                if l not in lines[link]:
+                    lines[link].append(l)
+                continue
+            lines[link] = [l]
+
+            if link in done:
+                continue
+
+            key = kind, link in stale
+            to_query[key].append(link)
+            if len(to_query[key]) == batch_size:
+                yield kind, to_query[key]
+                to_query[key] = []
+
+    # Send the incomplete batches too.
+    for (kind, _), links in to_query.items():
+        if len(links) != 0:
+            yield kind, links
+
+######################################################
+
+# SEND THE QUERIES CONCURRENTLY
+
+def fetch_all(queries, endpoint, concurrency=4, on_result=None,
+              on_failure=None, max_concurrency=None, retries=5,
+              refresh=False, **options):
+
+    """
+    This function sends batched queries to a SPARQL endpoint and
+    returns their Pandas DataFrames in the same order as the queries.
+    The queries may come from a generator: they are only built
+    when there is room for them. Each item may also be a list of
+    queries, whose DataFrames are put together.
+
+    The number of queries in flight adapts to the endpoint (see Scheduler),
+    and failed queries are sent again after a delay. Queries which still
+    fail are not raised: their DataFrame is None and on_failure is called.
+
+    It also works from a notebook, where an event loop is already running:
+    the queries then run on their own event loop in a separate thread.
+
+    :param queries: An iterable of strings (or lists of strings)
+        containing queries written in SPARQL.
+    :param endpoint: A string containing the URL for the SPARQL endpoint.
+    :param concurrency: The number of queries in flight at first.
+    :param on_result: A function called with the index of each query
+        and its DataFrame, as soon as it is answered.
+    :param on_failure: A function called with the index of each query
+        which failed for good, and the last error.
+    :param max_concurrency: The maximum number of queries in flight
+        (by default, concurrency).
+    :param retries: The number of times a failed query is sent again.
+    :param refresh: If True, ignore the cached responses but store the
+        new ones. It may also be the set of the queries to refresh.
+    :param options: Keyword arguments passed on to query_db().
     
-    WHERE {
-        ?source bnf-onto:OCR|rdae:P30016|rdar:electronicReproduction <"""
+    """
 
-            # End of the query.
-            qe = """> ;  ?propriété ?valeur ;
-      		  rdar:expressionManifested ?expression.
-    	?expression ?role ?dude .
-        ?dude a foaf:Person ;
-              foaf:familyName ?nomFamille ;
-              foaf:givenName ?prénom.
-    }"""
-            # Assemble the query with the URL.
-            query = qb + l + qe
+    def query_one(query):
+        fresh = refresh if isinstance(refresh, bool) else query in refresh
+        return query_db(query, sc=None, endpoint=endpoint, refresh=fresh,
+                        **options)
+
+    def fetch_one(query):
+        if isinstance(query, str):
+            return query_one(query)
+        # Put together the results of the queries of a batch.
+        dfs = [df for df in map(query_one, query) if df is not None]
+        return pd.concat(dfs) if len(dfs) != 0 else None
+
+    scheduler = Scheduler(concurrency, max_concurrency or concurrency, retries)
+    engine = partial(_fetch_all, queries, fetch_one, scheduler,
+                     on_result, on_failure)
+
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        # No running loop (script, terminal): simply run ours.
+        return asyncio.run(engine())
+
+    # A loop is already running (Jupyter): run ours in another thread.
+    with ThreadPoolExecutor(max_workers=1) as runner:
+        return runner.submit(lambda: asyncio.run(engine())).result()
+
+async def _fetch_all(queries, fetch_one, scheduler, on_result=None,
+                     on_failure=None):
+
+    """
+    The asynchronous engine behind fetch_all(). query_db() is blocking,
+    so each call runs in a worker thread. A new query is only taken
+    from the iterable when the scheduler has room for it.
+
+    :param queries: An iterable of strings (or lists of strings)
+        containing queries written in SPARQL.
+    :param fetch_one: A function sending a query (or a list of queries)
+        and returning a DataFrame.
+    :param scheduler: The Scheduler deciding how many queries
+        are in flight, and when to send them again.
+    :param on_result: A function called with the index of each query
+        and its DataFrame, as soon as it is answered.
+    :param on_failure: A function called with the index of each query
+        which failed for good, and the last error.
     
-            # Send the query to the SPARQL endpoint and
-            # transform the Json results into a Pandas DataFrame.
-            results_df = query_db(query, link, "https://data.bnf.fr/sparql")
+    """
 
-            # Add the Pandas DataFrame to the list.
-            all_dfs.append(results_df)
+    # A terminal or a notebook progress bar, whichever fits.
+    from tqdm.auto import tqdm
+
+    loop = asyncio.get_running_loop()
+    queries = enumerate(queries)
+    results = {}
+    in_flight = set()
+    progress = tqdm(total=None)
+
+    async def fetch(i, query):
+        attempt = 0
+        while True:
+            await scheduler.wait()
+            try:
+                df = await loop.run_in_executor(executor, fetch_one, query)
+            except Exception as error:
+                delay = scheduler.failed(error, attempt)
+                if delay is None:
+                    return i, None, error
+                attempt += 1
+                await asyncio.sleep(delay)
+            else:
+                scheduler.succeeded()
+                return i, df, None
+
+    with ThreadPoolExecutor(max_workers=scheduler.maximum) as executor:
+        try:
+            exhausted = False
+            while True:
+                # Fill the free slots with the next queries.
+                if not exhausted:
+                    free = max(0, scheduler.slots() - len(in_flight))
+                    added = 0
+                    for i, query in islice(queries, free):
+                        in_flight.add(asyncio.ensure_future(fetch(i, query)))
+                        added += 1
+                    exhausted = added < free
+
+                # There is always a free slot when nothing is in flight.
+                if len(in_flight) == 0:
+                    break
+
+                finished, in_flight = await asyncio.wait(
+                    in_flight, return_when=asyncio.FIRST_COMPLETED)
+                for task in finished:
+                    i, df, error = task.result()
+                    results[i] = df
+                    # Callbacks all run in the loop's thread, one at a time.
+                    if error is not None:
+                        if on_failure is not None:
+                            on_failure(i, error)
+                    elif on_result is not None:
+                        on_result(i, df)
+                    progress.update()
+        finally:
+            progress.close()
+
+    # Keep the order of the queries, whatever
+    # the order in which the answers arrived.
+    return [results[i] for i in range(len(results))]
 
-        # If the line is an ARK URI:
-        elif "http://ark.bnf.fr" in l:
+######################################################
 
-            # Transform the URI into the corresponding DataBnF URI.
-            link = l.replace("ark.bnf", "data.bnf") + "#about"
+# ADAPT TO THE LOAD OF THE ENDPOINT
 
-            # Define the main parts of the query.
-            
-            # Beginning of the query.
-            qb = """
-    PREFIX bnf-onto: <http://data.bnf.fr/ontology/bnf-onto/>
-    PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
-    PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
-    PREFIX foaf: <http://xmlns.com/foaf/0.1/>
-    PREFIX rdar: <http://rdvocab.info/RDARelationshipsWEMI/>
+# The HTTP status codes worth trying again.
+RETRY_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+
+class IncompleteResults(ValueError):
+    # SPARQL results cut short, as when the connection drops.
+    pass
+
+# The errors of a response cut short or garbled on the way,
+# worth trying again (other ValueErrors are not).
+DECODE_ERRORS = (IncompleteResults, json.JSONDecodeError, UnicodeDecodeError,
+                 zlib.error, pd.errors.ParserError)
+
+class Scheduler:
+
+    """
+    This class decides how many queries are in flight, and when
+    a failed query is sent again.
+
+    The number of queries in flight follows an AIMD rule: it grows
+    by about one for every round of successful queries, up to maximum,
+    and is halved on each error (down to minimum).
+    Failed queries are sent again after an exponential delay
+    with random jitter, or after the delay asked by the endpoint
+    with a Retry-After header, during which no other query is sent.
+
+    :param concurrency: The number of queries in flight at first.
+    :param maximum: The maximum number of queries in flight.
+    :param retries: The number of times a failed query is sent again.
+    :param base_delay: The delay before the first retry, in seconds.
+    :param max_delay: The maximum delay before a retry, in seconds.
+    :param minimum: The minimum number of queries in flight.
     
-    SELECT DISTINCT ?source ?propriété ?valeur ?role ?nomFamille ?prénom
+    """
+
+    def __init__(self, concurrency=4, maximum=16, retries=5, base_delay=1,
+                 max_delay=60, minimum=1):
+        self.maximum = max(maximum, concurrency)
+        self.minimum = minimum
+        self.limit = float(concurrency)
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        # No query is sent before this time (see Retry-After).
+        self.paused_until = 0
+
+    def slots(self):
+
+        """
+        Return the number of queries which may be in flight now.
+        
+        """
+
+        return int(self.limit)
+
+    async def wait(self):
+
+        """
+        Wait until the endpoint may be queried again.
+        
+        """
+
+        delay = self.paused_until - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def succeeded(self):
+
+        """
+        Additive increase, after a successful query.
+        
+        """
+
+        self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+    def failed(self, error, attempt):
+
+        """
+        Multiplicative decrease, after a failed query. Return the delay
+        before sending the query again, or None if it should not be.
+
+        :param error: The exception raised by the query.
+        :param attempt: The number of times the query was already sent again.
+        
+        """
+
+        if not is_retryable(error):
+            return None
+
+        self.limit = max(self.minimum, self.limit / 2)
+        if attempt >= self.retries:
+            return None
+
+        # Exponential backoff, with jitter so that the failed
+        # queries are not all sent again at the same time.
+        delay = random.uniform(
+            0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+        # The endpoint may tell how long to wait.
+        asked = retry_after(error)
+        if asked is not None:
+            delay = max(delay, asked)
+            self.paused_until = max(self.paused_until,
+                                    time.monotonic() + asked)
+
+        return delay
+
+def is_retryable(error):
+
+    """
+    Tell whether a failed query is worth sending again: network errors,
+    timeouts, HTTP errors meaning the endpoint is overloaded, and
+    responses which could not be decoded (see DECODE_ERRORS).
+
+    :param error: The exception raised by the query.
     
-    WHERE {
-      	BIND ( """
+    """
 
-            # End of the query.
-            qe = """ as ?source)
-        ?source ?propriété ?valeur ;
-      		  rdar:expressionManifested ?expression.
-    	?expression ?role ?dude .
-        ?dude a foaf:Person ;
-              foaf:familyName ?nomFamille ;
-              foaf:givenName ?prénom.
-    }"""
-            
-            # Assemble the query with the URI.
-            query = qb+"<"+link+">"+qe
-            
-            # Send the query to the SPARQL endpoint and
-            # transform the Json results into a Pandas DataFrame.
-            results_df = query_db(query, link, "https://data.bnf.fr/sparql")
-            # Add the Pandas DataFrame to the list.
-            all_dfs.append(results_df)
-
-        # Other options are not yet included.
+    if isinstance(error, HTTPError):
+        return error.code in RETRY_STATUSES
+    return isinstance(error, (OSError, http.client.HTTPException)
+                      + DECODE_ERRORS)
+
+def retry_after(error):
+
+    """
+    Return the number of seconds the endpoint asked to wait
+    in a Retry-After header, or None.
+
+    :param error: The exception raised by the query.
+    
+    """
+
+    headers = getattr(error, "headers", None)
+    value = headers.get("Retry-After") if headers is not None else None
+    if value is None:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    # Otherwise it is an HTTP date.
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+######################################################
+
+# MEASURE WHERE THE TIME GOES
+
+class Metrics:
+
+    """
+    This class records where a run spends its time: the wall time of
+    each stage, the latency of each query, the bytes received, the rows
+    per link and the peak memory. It is shared by the threads sending
+    the queries.
+
+    A disabled Metrics object records nothing, so that the functions
+    can always call it.
+
+    :param enabled: A boolean telling whether to record anything.
+    :param memory: A boolean telling whether to trace the peak memory
+        with tracemalloc, which slows the run down.
+    
+    """
+
+    def __init__(self, enabled=True, memory=True):
+        self.enabled = enabled
+        self.memory = memory
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.counters = {}
+        self.latencies = []
+        self.rows_per_link = []
+        self.bytes_received = 0
+        self.wall = 0.0
+        self.peak_memory = None
+        self.started = None
+        self.tracing = False
+
+    def start(self):
+        if not self.enabled:
+            return
+        self.started = time.perf_counter()
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.tracing = True
+
+    def stop(self):
+        if not self.enabled or self.started is None:
+            return
+        self.wall += time.perf_counter() - self.started
+        self.started = None
+        if tracemalloc.is_tracing():
+            peak = tracemalloc.get_traced_memory()[1]
+            self.peak_memory = max(self.peak_memory or 0, peak)
+            if self.tracing:
+                tracemalloc.stop()
+                self.tracing = False
+
+    @contextmanager
+    def stage(self, name):
+        # Time the content of the with block.
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def timed(self, iterable, name):
+        # Time the production of each item of a generator,
+        # not what is done with it.
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add(name, time.perf_counter() - start)
+                return
+            self.add(name, time.perf_counter() - start)
+            yield item
+
+    def add(self, name, seconds):
+        if not self.enabled:
+            return
+        with self.lock:
+            calls, total = self.stages.get(name, (0, 0.0))
+            self.stages[name] = (calls + 1, total + seconds)
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def query(self, seconds):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.latencies.append(seconds)
+
+    def received(self, size):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.bytes_received += size
+
+    def rows(self, links, df):
+        # Count the rows answered for each link of a batch.
+        if not self.enabled:
+            return
+        if df is None:
+            counts = [0] * len(links)
         else:
-            print(f"{l} is not a URL/URI we can use for now.")
+            counts = df["Source"].value_counts().reindex(
+                links, fill_value=0).tolist()
+        with self.lock:
+            self.rows_per_link.extend(counts)
 
-    # Assemble all DataFrames into one.
-    all_results = pd.concat(all_dfs)
+    def summary(self):
 
-    # Reorder the DataFrame to have one line per book and show it.
-    final = pd.DataFrame(reorder(all_results))
-    display(final)
+        """
+        Return the measures of the run as a dictionary.
+        
+        """
+
+        def quantiles(values):
+            if not values:
+                return {}
+            p50, p95, p99 = np.percentile(values, [50, 95, 99])
+            return {"p50": float(p50), "p95": float(p95), "p99": float(p99),
+                    "max": float(max(values)), "mean": float(np.mean(values))}
+
+        with self.lock:
+            return {
+                "wall_seconds": self.wall,
+                "peak_memory_bytes": self.peak_memory,
+                "bytes_received": self.bytes_received,
+                "queries": len(self.latencies),
+                "query_latency_seconds": quantiles(self.latencies),
+                "links": len(self.rows_per_link),
+                "rows_per_link": quantiles(self.rows_per_link),
+                "stages": {name: {"calls": calls, "seconds": seconds}
+                           for name, (calls, seconds) in self.stages.items()},
+                "counters": dict(self.counters)}
+
+    def write_json(self, path="run_metrics.json"):
+
+        """
+        Write the summary of the run into a JSON file.
+
+        :param path: A string containing the path to the output file.
+        
+        """
+
+        write_atomic(path, json.dumps(self.summary(), indent=2))
+
+    def write_prometheus(self, path="run_metrics.prom"):
 
-    # Write the resulting DataFrame into an XLSX file.
-    final.to_excel("iiif_metadata.xlsx")
+        """
+        Write the summary of the run in the Prometheus textfile format,
+        to be collected by the textfile collector of node_exporter.
+
+        :param path: A string containing the path to the output file.
+        
+        """
+
+        summary = self.summary()
+        with self.lock:
+            latencies = list(self.latencies)
+            rows = list(self.rows_per_link)
+        lines = []
+
+        def metric(name, kind, help, samples):
+            # Each sample is a (suffix, labels, value) tuple.
+            name = "gallica2biblio_" + name
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for suffix, labels, value in samples:
+                labels = ",".join(f'{k}="{prom_label(v)}"'
+                                  for k, v in labels.items())
+                labels = "{%s}" % labels if labels else ""
+                lines.append(f"{name}{suffix}{labels} {value}")
+
+        def quantiles(values, measured):
+            # The samples of a Prometheus summary.
+            samples = [("", {"quantile": q}, measured[p])
+                       for q, p in (("0.5", "p50"), ("0.95", "p95"),
+                                    ("0.99", "p99")) if p in measured]
+            return samples + [("_sum", {}, sum(values)),
+                              ("_count", {}, len(values))]
+
+        metric("wall_seconds", "gauge", "Wall time of the run.",
+               [("", {}, summary["wall_seconds"])])
+        if summary["peak_memory_bytes"] is not None:
+            metric("peak_memory_bytes", "gauge",
+                   "Peak memory traced by tracemalloc.",
+                   [("", {}, summary["peak_memory_bytes"])])
+        metric("received_bytes_total", "counter",
+               "Bytes received from the endpoint.",
+               [("", {}, summary["bytes_received"])])
+        metric("stage_seconds_total", "counter",
+               "Wall time spent in each stage.",
+               [("", {"stage": name}, s["seconds"])
+                for name, s in summary["stages"].items()])
+        metric("stage_calls_total", "counter",
+               "Number of times each stage ran.",
+               [("", {"stage": name}, s["calls"])
+                for name, s in summary["stages"].items()])
+        metric("events_total", "counter", "Number of events of each kind.",
+               [("", {"event": name}, n)
+                for name, n in summary["counters"].items()])
+        metric("query_latency_seconds", "summary",
+               "Latency of the queries sent to the endpoint.",
+               quantiles(latencies, summary["query_latency_seconds"]))
+        metric("rows_per_link", "summary",
+               "Number of result rows for each link.",
+               quantiles(rows, summary["rows_per_link"]))
+
+        write_atomic(path, "\n".join(lines) + "\n")
+
+# Recording nothing, for the functions called without a Metrics object.
+NO_METRICS = Metrics(enabled=False)
+
+def prom_label(value):
+    # Escape a label value for the Prometheus textfile format.
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace(
+        "\n", "\\n")
+
+def write_atomic(path, text):
+    # Write the whole file or nothing, as it may be read at any time.
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp, path)
 
 ######################################################
 
 # SEND THE QUERY TO DATA BNF AND RETURN A PANDAS DATAFRAME 
 
-def query_db(query_str, sc, endpoint):
+# The MIME type to request for each result format.
+RESULT_FORMATS = {
+    "json": "application/sparql-results+json",
+    "csv": "text/csv",
+    "tsv": "text/tab-separated-values"
+}
+
+def query_db(query_str, sc, endpoint, cache=None, refresh=False, pool=None,
+             result_format="json", metrics=None):
 
     """
     This function communicates with a SPARQL endpoint
     and returns the response as a Pandas DataFrame.
+    If a cache is given, it is consulted before the endpoint.
 
     :param query_str: A string containing a query written in SPARQL.
     :param sc: A string containing the link around which the query
-        was built.
-    :param endpoint: A string containing the URL for the SPARQL endpoint.
+        was built, or None if the query selects a ?link for each result
+        (batched queries).
+    :param endpoint: A string containing the URL for the SPARQL endpoint,
+        or "local:" followed by the path to a LocalStore built from
+        the DataBnF dumps (see local_store.py).
+    :param cache: A QueryCache, or None to always ask the endpoint.
+    :param refresh: If True, ignore the cached response but store
+        the new one.
+    :param pool: The ConnectionPool to send the query through
+        (by default, the shared pool of the endpoint).
+    :param result_format: The format in which the endpoint sends
+        the results: "json", "csv" or "tsv".
+    :param metrics: A Metrics object recording the time spent
+        in each stage, or None.
     
     """
 
-    # Specify the DBPedia endpoint
-    sparql = SPARQLWrapper(endpoint)
+    if metrics is None:
+        metrics = NO_METRICS
+
+    # A local store answers at disk speed: no need for the cache.
+    if endpoint.startswith("local:"):
+        start = time.perf_counter()
+        output = get_store(endpoint).answer(query_str)
+        metrics.query(time.perf_counter() - start)
+        with metrics.stage("to_pd_df"):
+            return columns_to_df(output, sc)
+
+    # Look for the response in the cache first.
+    output = None
+    if cache is not None and not refresh:
+        with metrics.stage("cache"):
+            output = cache.get(query_str, endpoint, result_format)
+        metrics.count("cache hits" if output is not None else "cache misses")
+
+    if output is None:
+        # Send the query through a keep-alive connection to the endpoint,
+        # and read the results as the response arrives.
+        if pool is None:
+            pool = get_pool(endpoint)
+        start = time.perf_counter()
+        with pool.open(query_str, RESULT_FORMATS[result_format],
+                       metrics) as stream:
+            if result_format == "json":
+                output = read_json_results(stream)
+            else:
+                output = read_csv_results(stream, result_format)
 
-    # Specify the query.
-    sparql.setQuery(query_str)
+        # What was not spent waiting for the network was spent decoding.
+        elapsed = time.perf_counter() - start
+        metrics.query(elapsed)
+        metrics.add(f"{result_format} decode", elapsed - stream.waited)
 
-    # Convert results to JSON format
-    sparql.setReturnFormat(JSON)
-    result = sparql.query().convert()
-    output = result["results"]["bindings"]
+        # Keep the response for the next runs.
+        if cache is not None:
+            with metrics.stage("cache"):
+                cache.put(query_str, endpoint, result_format, output)
 
     # Return the results as a Pandas DataFrame.
-    return to_pd_df(output, sc)
+    with metrics.stage("to_pd_df"):
+        return columns_to_df(output, sc)
+
+######################################################
+
+# JOURNAL THE RESULTS OF EACH LINK
+
+def write_journal(jf, links, df):
+
+    """
+    This function appends the results of a batch to the journal,
+    as one Json line per link, so that an interrupted run can resume.
+    Links without results are journaled too, with no rows.
+
+    :param jf: The journal, as a file opened for appending.
+    :param links: The list of links of the batch.
+    :param df: The Pandas DataFrame returned by query_db() for
+        the batch, or None if there were no results.
+    
+    """
+
+    rows = {link: [] for link in links}
+    now = time.time()
+    if df is not None:
+        # Missing values become null: string columns keep NaN
+        # through replace(), and NaN is not valid Json.
+        for row in df.astype(object).where(df.notna(), None).to_dict(
+                "records"):
+            rows[row["Source"]].append(row)
+
+    for link in links:
+        jf.write(json.dumps({"link": link, "rows": rows[link], "time": now},
+                            ensure_ascii=False, allow_nan=False) + "\n")
+
+    # Make sure it is on disk before the next batch.
+    jf.flush()
+
+def read_journal(journal, max_age=None, stale=None):
+
+    """
+    This function reads a journal written by write_journal() and
+    returns a dict of the journaled links and their rows.
+
+    :param journal: The path to the journal.
+    :param max_age: The number of seconds after which journaled
+        results are left out, or None to keep them all.
+    :param stale: A dict filled with the links left out
+        and their rows.
+    
+    """
+
+    done = {}
+    if stale is None:
+        stale = {}
+    now = time.time()
+    try:
+        with open(journal, encoding="utf-8") as jf:
+            for line in jf:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # The last line of a crashed run may be incomplete.
+                    continue
+                # Journals written before timestamps count as old.
+                link = entry["link"]
+                if max_age is not None and \
+                        now - entry.get("time", 0) > max_age:
+                    stale[link] = entry["rows"]
+                    done.pop(link, None)
+                else:
+                    done[link] = entry["rows"]
+                    stale.pop(link, None)
+    except FileNotFoundError:
+        pass
+
+    return done
+
+def compact_journal(journal, links):
+
+    """
+    This function rewrites a journal with the last entry of each
+    of the given links only, dropping the links which left the list.
+
+    :param journal: The path to the journal.
+    :param links: The links to keep.
+    
+    """
+
+    entries = {}
+    with open(journal, encoding="utf-8") as jf:
+        for line in jf:
+            try:
+                link = json.loads(line)["link"]
+            except json.JSONDecodeError:
+                continue
+            if link in links:
+                entries[link] = line
+
+    write_atomic(journal, "".join(entries.values()))
 
 ######################################################
 
-# GET THE JSON RESULTS FROM A DATA BNF QUERY AND TURN THEM
-# INTO A PANDAS DATAFRAME
+# KEEP THE CONNECTIONS TO THE ENDPOINT OPEN
+
+class ConnectionPool:
+
+    """
+    A pool of keep-alive HTTP(S) connections to one SPARQL endpoint,
+    shared by all the queries of a run, so that the TCP and TLS
+    handshakes are only paid once per connection.
+
+    Responses are requested compressed (gzip or deflate)
+    and decompressed on arrival.
+
+    :param endpoint: A string containing the URL for the SPARQL endpoint.
+    :param size: The maximum number of open connections.
+    :param timeout: The number of seconds to wait for the endpoint.
+    
+    """
+
+    def __init__(self, endpoint, size=8, timeout=120):
+        url = urlsplit(endpoint)
+        self.endpoint = endpoint
+        self.size = size
+        self.timeout = timeout
+        self.https = url.scheme == "https"
+        self.host = url.hostname
+        self.port = url.port
+        self.path = url.path or "/"
+        if url.query:
+            self.path += "?" + url.query
+
+        # Idle connections, most recently used first, and one
+        # slot per connection that may be open at the same time.
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(size)
+
+    def connect(self):
+
+        """
+        Open a new connection to the endpoint.
+        
+        """
+
+        if self.https:
+            return http.client.HTTPSConnection(
+                self.host, self.port, timeout=self.timeout)
+        return http.client.HTTPConnection(
+            self.host, self.port, timeout=self.timeout)
+
+    @contextmanager
+    def open(self, query_str, accept, metrics=None):
+
+        """
+        Send a query to the endpoint and give the body of the response
+        as a decompressed binary stream, to be read within the with block.
+        The connection goes back to the pool afterwards.
+
+        The stream tells how many seconds were spent waiting for the
+        network (waited) and how many bytes were received (received).
+
+        :param query_str: A string containing a query written in SPARQL.
+        :param accept: The MIME type of the expected results.
+        :param metrics: A Metrics object recording the network wait
+            and the bytes received, or None.
+        
+        """
+
+        if metrics is None:
+            metrics = NO_METRICS
+
+        body = urlencode({"query": query_str}).encode()
+        headers = {
+            "Content-Type": "application/x-www-form-urlencoded",
+            "Accept": accept,
+            "Accept-Encoding": "gzip, deflate",
+            "Connection": "keep-alive",
+            "User-Agent": "Gallica2biblio"
+        }
+
+        with self.slots:
+            start = time.perf_counter()
+            try:
+                conn = self.idle.get_nowait()
+                reused = True
+            except queue.Empty:
+                conn = self.connect()
+                reused = False
+
+            try:
+                conn.request("POST", self.path, body, headers)
+                response = conn.getresponse()
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                # The endpoint may have closed an idle connection:
+                # try once again with a fresh one.
+                if not reused:
+                    raise
+                conn = self.connect()
+                conn.request("POST", self.path, body, headers)
+                response = conn.getresponse()
+
+            stream = CountingReader(response, time.perf_counter() - start)
+            try:
+                if response.status != 200:
+                    stream.read()
+                    raise HTTPError(self.endpoint, response.status,
+                                    response.reason, response.headers, None)
+
+                encoding = response.getheader("Content-Encoding", "")
+                if encoding in ("gzip", "deflate"):
+                    yield Inflater(stream, encoding)
+                else:
+                    yield stream
+
+                # Finish reading the response to reuse the connection.
+                stream.read()
+            except BaseException:
+                conn.close()
+                raise
+            finally:
+                metrics.add("network wait", stream.waited)
+                metrics.received(stream.received)
+
+            # Put the connection back, unless the endpoint closes it.
+            if response.will_close:
+                conn.close()
+            else:
+                self.idle.put(conn)
+
+    def post(self, query_str, accept):
+
+        """
+        Send a query to the endpoint and return the decompressed
+        body of the response as bytes.
+
+        :param query_str: A string containing a query written in SPARQL.
+        :param accept: The MIME type of the expected results.
+        
+        """
+
+        with self.open(query_str, accept) as stream:
+            return stream.read()
+
+    def close(self):
+
+        """
+        Close all idle connections.
+        
+        """
+
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+class CountingReader:
+
+    """
+    A binary stream which counts the bytes read from a response,
+    and the time spent waiting for them.
+
+    :param raw: The response.
+    :param waited: The seconds already spent waiting for the response.
+    
+    """
+
+    def __init__(self, raw, waited=0.0):
+        self.raw = raw
+        self.waited = waited
+        self.received = 0
+
+    def read(self, size=-1):
+        start = time.perf_counter()
+        data = self.raw.read() if size is None or size < 0 else self.raw.read(size)
+        self.waited += time.perf_counter() - start
+        self.received += len(data)
+        return data
+
+class Inflater:
+
+    """
+    A binary stream which decompresses a gzip or deflate response
+    as it is read.
+
+    :param raw: The compressed stream.
+    :param encoding: "gzip" or "deflate".
+    
+    """
+
+    def __init__(self, raw, encoding):
+        self.raw = raw
+        self.encoding = encoding
+        self.inflate = None
+        self.buffer = b""
+
+    @property
+    def waited(self):
+        # The time spent waiting is counted by the raw stream.
+        return getattr(self.raw, "waited", 0.0)
+
+    def read(self, size=-1):
+        # Read and decompress until there is enough data.
+        while size < 0 or len(self.buffer) < size:
+            data = self.raw.read(65536)
+            if not data:
+                if self.inflate is not None:
+                    self.buffer += self.inflate.flush()
+                break
+
+            if self.inflate is None:
+                if self.encoding == "gzip":
+                    wbits = 16 + zlib.MAX_WBITS
+                # Some servers send raw deflate data without the zlib header.
+                elif data[0] & 0x0F == 8:
+                    wbits = zlib.MAX_WBITS
+                else:
+                    wbits = -zlib.MAX_WBITS
+                self.inflate = zlib.decompressobj(wbits)
+            self.buffer += self.inflate.decompress(data)
+
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+# One shared pool per endpoint.
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_pool(endpoint, size=None, timeout=None):
+
+    """
+    Return the shared ConnectionPool of an endpoint, creating it if needed.
+
+    :param endpoint: A string containing the URL for the SPARQL endpoint.
+    :param size: The number of connections of the pool. If the existing
+        pool has another size, it is replaced.
+    :param timeout: The number of seconds to wait for the endpoint. If the
+        existing pool has another timeout, it is replaced.
+    
+    """
+
+    with _pools_lock:
+        pool = _pools.get(endpoint)
+        if (pool is None or (size is not None and size != pool.size)
+                or (timeout is not None and timeout != pool.timeout)):
+            if pool is not None:
+                pool.close()
+            pool = ConnectionPool(endpoint, size or 8, timeout or 120)
+            _pools[endpoint] = pool
+        return pool
+
+# One shared store per file.
+_stores = {}
+
+def get_store(endpoint):
+
+    """
+    Return the shared LocalStore of a "local:path" endpoint,
+    opening it if needed.
+
+    :param endpoint: "local:" followed by the path to the store.
+    
+    """
+
+    from local_store import LocalStore
+
+    with _pools_lock:
+        if endpoint not in _stores:
+            path = endpoint[len("local:"):]
+            if not os.path.exists(path):
+                raise FileNotFoundError(
+                    f"{path}: build the local store with LocalStore.ingest().")
+            _stores[endpoint] = LocalStore(path)
+        return _stores[endpoint]
+
+######################################################
+
+# KEEP THE RESPONSES ON DISK BETWEEN RUNS
+
+class QueryCache:
+
+    """
+    A persistent cache of SPARQL responses, stored in an SQLite file.
+
+    Responses are keyed by the endpoint, the query text (with its
+    whitespace normalised) and the result format, and their result
+    columns are stored as compressed Json. Entries older than ttl
+    seconds are ignored, and the least recently used entries are
+    removed once the cache grows over max_size.
+
+    :param path: The path to the SQLite file (created if needed).
+    :param ttl: The number of seconds a response stays valid,
+        or None to keep responses forever.
+    :param max_size: The maximum total size of the stored responses
+        in bytes, or None for no limit.
+    
+    """
+
+    def __init__(self, path="sparql_cache.sqlite", ttl=30*24*3600,
+                 max_size=500*1024**2):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+
+        # The cache is shared by the threads of fetch_all().
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                stored REAL,
+                used REAL,
+                size INTEGER,
+                data BLOB)""")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS names (
+                endpoint TEXT,
+                uri TEXT,
+                stored REAL,
+                names TEXT,
+                PRIMARY KEY (endpoint, uri))""")
+        self.db.commit()
+
+    @staticmethod
+    def key(query_str, endpoint, fmt):
+
+        """
+        Build the cache key of a query sent to an endpoint.
+
+        :param query_str: A string containing a query written in SPARQL.
+        :param endpoint: A string containing the URL for the SPARQL endpoint.
+        :param fmt: The format in which the results were requested.
+        
+        """
+
+        normalised = " ".join(query_str.split())
+        return hashlib.sha256(
+            f"{endpoint}\n{fmt}\n{normalised}".encode()).hexdigest()
+
+    def get(self, query_str, endpoint, fmt):
+
+        """
+        Return the cached results of a query, or None if they are
+        missing or expired.
+
+        :param query_str: A string containing a query written in SPARQL.
+        :param endpoint: A string containing the URL for the SPARQL endpoint.
+        :param fmt: The format in which the results were requested.
+        
+        """
+
+        key = self.key(query_str, endpoint, fmt)
+        now = time.time()
+
+        with self.lock:
+            row = self.db.execute(
+                "SELECT stored, data FROM responses WHERE key = ?",
+                (key,)).fetchone()
+            if row is None:
+                return None
+            if self.ttl is not None and now - row[0] > self.ttl:
+                self.db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.db.commit()
+                return None
+
+            # Remember the use for the LRU eviction.
+            self.db.execute(
+                "UPDATE responses SET used = ? WHERE key = ?", (now, key))
+            self.db.commit()
+
+        return json.loads(zlib.decompress(row[1]))
+
+    def put(self, query_str, endpoint, fmt, results):
+
+        """
+        Store the results of a query, then evict the least recently
+        used responses if the cache is too big.
+
+        :param query_str: A string containing a query written in SPARQL.
+        :param endpoint: A string containing the URL for the SPARQL endpoint.
+        :param fmt: The format in which the results were requested.
+        :param results: The results of the query, as returned
+            by read_json_results() or read_csv_results().
+        
+        """
+
+        key = self.key(query_str, endpoint, fmt)
+        data = zlib.compress(json.dumps(
+            results, default=lambda column: column.tolist()).encode())
+        now = time.time()
+
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                (key, now, now, len(data), data))
+            self.evict()
+            self.db.commit()
+
+    def evict(self):
+
+        """
+        Remove the least recently used responses until the cache
+        fits in max_size. Must be called with the lock held.
+        
+        """
+
+        if self.max_size is None:
+            return
+
+        total = self.db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_size:
+            return
+
+        for key, size in self.db.execute(
+                "SELECT key, size FROM responses ORDER BY used").fetchall():
+            self.db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            total -= size
+            if total <= self.max_size:
+                break
+
+    def get_names(self, uris, endpoint):
+
+        """
+        Return the cached names of persons, as a dict of each URI and
+        its list of [family name, given name] pairs. Missing and
+        expired persons are left out.
+
+        :param uris: The URIs of the persons.
+        :param endpoint: A string containing the URL for the SPARQL endpoint.
+        
+        """
+
+        uris = list(uris)
+        oldest = -1 if self.ttl is None else time.time() - self.ttl
+        names = {}
+
+        # SQLite takes a limited number of parameters per statement.
+        with self.lock:
+            for i in range(0, len(uris), 500):
+                chunk = uris[i:i + 500]
+                for uri, found in self.db.execute(
+                        "SELECT uri, names FROM names WHERE endpoint = ? "
+                        "AND stored > ? AND uri IN (%s)"
+                        % ", ".join("?" * len(chunk)),
+                        [endpoint, oldest] + chunk):
+                    names[uri] = json.loads(found)
+
+        return names
+
+    def put_names(self, names, endpoint):
+
+        """
+        Store the names of persons.
+
+        :param names: A dict of each URI and its list of
+            [family name, given name] pairs.
+        :param endpoint: A string containing the URL for the SPARQL endpoint.
+        
+        """
+
+        now = time.time()
+        with self.lock:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO names VALUES (?, ?, ?, ?)",
+                [(endpoint, uri, now, json.dumps(found, ensure_ascii=False))
+                 for uri, found in names.items()])
+            self.db.commit()
+
+    def clear(self):
+
+        """
+        Remove every response and every name from the cache.
+        
+        """
+
+        with self.lock:
+            self.db.execute("DELETE FROM responses")
+            self.db.execute("DELETE FROM names")
+            self.db.commit()
+
+######################################################
+
+# READ THE JSON RESULTS FROM A DATA BNF QUERY AS THEY ARRIVE
+
+def read_json_results(stream, chunk_size=65536):
+
+    """
+    This function reads SPARQL Json results from a binary stream, one
+    binding at a time, straight into one list per variable. The variables
+    are taken once from the header of the results, so the whole document
+    is never held in memory.
+
+    It returns a dict with the variables ("vars") and
+    the columns of values ("columns").
+
+    :param stream: A binary stream containing SPARQL Json results.
+    :param chunk_size: The number of bytes read at a time.
+    
+    """
+
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    buf = ""
+    pos = 0
+    eof = False
+
+    def more():
+        # Read the next chunk, dropping what was already parsed.
+        nonlocal buf, pos, eof
+        data = stream.read(chunk_size)
+        eof = not data
+        buf = buf[pos:] + utf8.decode(data, final=eof)
+        pos = 0
+        if eof and not buf.strip():
+            raise IncompleteResults("Incomplete SPARQL Json results.")
+
+    def find(token):
+        # Move just after the next occurrence of token.
+        nonlocal pos
+        while True:
+            found = buf.find(token, pos)
+            if found != -1:
+                pos = found + len(token)
+                return
+            # Keep the end of the buffer, in case token was cut in two.
+            pos = max(pos, len(buf) - len(token))
+            if eof:
+                raise IncompleteResults(
+                    f"No {token} in the SPARQL Json results.")
+            more()
+
+    def skip(chars):
+        # Move to the next character which is not in chars.
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos] in chars:
+                pos += 1
+            if pos < len(buf):
+                return
+            if eof:
+                raise IncompleteResults("Incomplete SPARQL Json results.")
+            more()
+
+    def decode():
+        # Decode the next complete Json value.
+        nonlocal pos
+        while True:
+            try:
+                value, pos = decoder.raw_decode(buf, pos)
+                return value
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                more()
+
+    # The SELECT header gives the variables, in order.
+    find('"vars"')
+    skip(" \t\r\n:")
+    variables = decode()
+    columns = {var: [] for var in variables}
+
+    # Then fill the columns, one binding at a time.
+    find('"bindings"')
+    skip(" \t\r\n:")
+    pos += 1  # "["
+    while True:
+        skip(" \t\r\n,")
+        if buf[pos] == "]":
+            break
+        binding = decode()
+        for var in variables:
+            term = binding.get(var)
+            columns[var].append(None if term is None else term["value"])
+
+    return {"vars": variables, "columns": columns}
+
+# A term of the TSV results: an IRI, or a literal
+# with an optional language tag or datatype.
+TSV_TERM = r'^(?:<(?P<iri>.*)>|"(?P<literal>.*)"(?:@[\w-]+|\^\^<.*>)?)$'
+
+# An escape sequence in a TSV literal.
+TSV_ESCAPE = r'\\(?:u([0-9A-Fa-f]{4})|U([0-9A-Fa-f]{8})|(.))'
+
+def unescape_tsv(match):
+
+    """
+    Replace an escape sequence matched by TSV_ESCAPE with its character.
+
+    :param match: The match of TSV_ESCAPE.
+    
+    """
+
+    code = match[1] or match[2]
+    if code is not None:
+        return chr(int(code, 16))
+    return {"t": "\t", "n": "\n", "r": "\r", "b": "\b",
+            "f": "\f"}.get(match[3], match[3])
+
+def read_csv_results(stream, result_format="csv"):
+
+    """
+    This function reads SPARQL CSV or TSV results from a binary stream
+    with the columnar CSV reader of Pandas. It returns the same dict of
+    variables and columns as read_json_results().
+
+    :param stream: A binary stream containing SPARQL CSV or TSV results.
+    :param result_format: "csv" or "tsv".
+    
+    """
+
+    try:
+        if result_format == "csv":
+            df = pd.read_csv(stream, dtype=str, keep_default_na=False,
+                             na_values=[""])
+        else:
+            df = pd.read_csv(stream, sep="\t", dtype=str, quoting=csv.QUOTE_NONE,
+                             keep_default_na=False, na_values=[""])
+    except pd.errors.EmptyDataError:
+        return {"vars": [], "columns": {}}
+
+    if result_format == "tsv":
+        # Variables are written ?var, and values in Turtle syntax.
+        df.columns = [var.lstrip("?") for var in df.columns]
+        for var in df.columns:
+            terms = df[var].str.extract(TSV_TERM)
+            literal = terms["literal"].str.replace(
+                TSV_ESCAPE, unescape_tsv, regex=True)
+            # Anything else (numbers, booleans...) stays as written.
+            df[var] = terms["iri"].fillna(literal).fillna(df[var])
+
+    columns = {var: df[var].astype(object).where(df[var].notna(), None)
+               .to_numpy() for var in df.columns}
+    return {"vars": list(df.columns), "columns": columns}
+
+def columns_to_df(results, sc):
+
+    """
+    This function takes the columns read from the results of a SPARQL
+    query and transforms them into a Pandas DataFrame, using the
+    variables as column heads.
+
+    :param results: The results of a SPARQL query, as returned
+        by read_json_results() or read_csv_results().
+    :param sc: The link around which the query was built,
+        to include in a new column. If None, the ?link value
+        of each result is used instead.
+    
+    """
+
+    columns = results["columns"]
+    variables = results["vars"]
+    if len(variables) == 0 or len(columns[variables[0]]) == 0:
+        return None
+
+    # In batched queries, ?link only goes into the Source column.
+    if sc is None:
+        to_pd_df = {"Source": columns["link"]}
+    else:
+        to_pd_df = {"Source": [sc] * len(columns[variables[0]])}
+    for var in variables:
+        if not (sc is None and var == "link"):
+            to_pd_df[var] = columns[var]
+
+    # Transform the dict in an actual Pandas.DataFrame
+    return pd.DataFrame(to_pd_df)
 
 def to_pd_df(dicolist, sc):
 
@@ -172,385 +1969,979 @@ def to_pd_df(dicolist, sc):
     :param dicolist: The results of a SPARQL query as a list
         of dictionaries [{}]
     :param sc: The link around which the query was built,
-        to include in a new column.
+        to include in a new column. If None, the ?link value
+        of each result is used instead.
     
     """
-    
-    if len(dicolist) != 0:
-
-        # Make sure you get all the possible column heads.
-        keys = []
-        for result in dicolist:
-            for key in result.keys():
-                if key not in keys:
-                    keys.append(key)
 
-        # Initiate the dataframe-to-be.
-        to_pd_df = {"Source":[]}
+    # Make sure you get all the possible column heads, in order.
+    keys = {}
+    for result in dicolist:
+        keys.update(dict.fromkeys(result))
 
-        # Initiate each column-to-be.
+    # Fill one column per key.
+    columns = {key: [] for key in keys}
+    for result in dicolist:
         for key in keys:
-            to_pd_df[key] = []
-
-        # Fill the dataframe-to-be.
-        for result in dicolist:
-            to_pd_df["Source"].append(sc)
-            for key in keys:
-                if key in result.keys():
-                    to_pd_df[key].append(result[key]["value"])
-                else:
-                    to_pd_df[key].append(None)
-                    
-        # Transform the dict in an actual Pandas.DataFrame
-        df = pd.DataFrame.from_dict(to_pd_df)
-    
-        return df
-        
-    else:
-        return None
+            term = result.get(key)
+            columns[key].append(None if term is None else term["value"])
+
+    return columns_to_df({"vars": list(keys), "columns": columns}, sc)
 
 ######################################################
 
 # SORT THE RESULTS THEMATICALLY TO PREPARE THE BIBLIOGRAPHY
 
-def reorder(df):
+# Define the columns of the new table.
+# Keys are the new columns.
+# Values are the corresponding DataBnF properties.
+SORT = {
+    "Title" : ["http://purl.org/dc/terms/title"],
+    "Author" :  [
+        "http://data.bnf.fr/vocabulary/roles/r70",
+        "http://id.loc.gov/vocabulary/relators/aut"],
+    "Sc. editor" : [
+        "http://data.bnf.fr/vocabulary/roles/r360",
+        "http://id.loc.gov/vocabulary/relators/edt"],
+    "Contributor" : ["http://purl.org/dc/terms/contributor"],
+    "Edition" : [
+        "http://rdaregistry.info/Elements/m/#P30133",
+        "http://rdvocab.info/Elements/designationOfEdition"],
+    "Date" : [
+        "http://data.bnf.fr/ontology/bnf-onto/firstYear",
+        "http://purl.org/dc/terms/date",
+        "http://rdaregistry.info/Elements/m/#P30011",
+        "http://rdvocab.info/Elements/dateOfPublicationManifestation"],
+    "Place" : [
+        "http://rdaregistry.info/Elements/m/#P30279",
+        "http://rdvocab.info/Elements/placeOfPublication"],
+    "Publisher" : [
+        "http://rdaregistry.info/Elements/m/#P30176",
+        "http://rdvocab.info/Elements/publishersName"],
+    "Publisher (full)" : ["http://purl.org/dc/terms/publisher"],
+    "Notes" : [
+        "http://rdaregistry.info/Elements/u/#P60470",
+        "http://rdvocab.info/Elements/note"],
+    "Facsimile" : [
+        "http://data.bnf.fr/ontology/bnf-onto/OCR",
+        "http://rdaregistry.info/Elements/m/#P30016",
+        "http://rdvocab.info/RDARelationshipsWEMI/electronicReproduction"],
+    "BnF identifier" : ["http://data.bnf.fr/ontology/bnf-onto/FRBNF"],
+    "Description" : ["http://purl.org/dc/terms/description"]
+}
+
+# The columns of the new table, in order.
+COLUMNS = [
+    "Title",
+    "Author",
+    "Sc. editor",
+    "Contributor",
+    "Other contributor",
+    "Edition",
+    "Date",
+    "Place",
+    "Publisher",
+    "Publisher (full)",
+    "Notes",
+    "Source",
+    "Facsimile",
+    "BnF identifier",
+    "Description",
+    "Other"
+]
+
+# The same mapping, inverted once: DataBnF property (or role) → column.
+ROLES = ["Author", "Sc. editor", "Contributor"]
+PROPERTY_COLUMNS = {p: col for col, props in SORT.items()
+                    if col not in ROLES for p in props}
+ROLE_COLUMNS = {r: col for col in ROLES[1:] for r in SORT[col]}
+
+# The properties to ask for in lean harvests (see build_queries()).
+LEAN_PROPERTIES = "VALUES ?propriété { %s }" % " ".join(
+    f"<{p}>" for p in PROPERTY_COLUMNS)
+
+def reorder(df, names=None):
 
     """
     This function groups the information to be human-readable
     and remove doubles (DataBnF usually encodes the same information
     several times according to different models).
 
+    Every row is mapped to its columns at once, then all values are
+    aggregated with a single groupby on the links.
+
     :param df: A Pandas DataFrame as produced by the concatenation of
         all DataFrames returned on the links by the the query_db() function.
+    :param names: A Pandas DataFrame with the names of the contributors,
+        as returned by resolve_names(), or None.
     
     """
 
-    # Define the columns of the new table.
-    # Keys are the new columns.
-    # Values are the corresponding DataBnF properties.
-    sort = {
-        "Title" : ["http://purl.org/dc/terms/title"],
-        "Author" :  [
-            "http://data.bnf.fr/vocabulary/roles/r70",
-            "http://id.loc.gov/vocabulary/relators/aut"],
-        "Sc. editor" : [
-            "http://data.bnf.fr/vocabulary/roles/r360",
-            "http://id.loc.gov/vocabulary/relators/edt"],
-        "Contributor" : ["http://purl.org/dc/terms/contributor"],
-        "Edition" : [
-            "http://rdaregistry.info/Elements/m/#P30133",
-            "http://rdvocab.info/Elements/designationOfEdition"],
-        "Date" : [
-            "http://data.bnf.fr/ontology/bnf-onto/firstYear",
-            "http://purl.org/dc/terms/date",
-            "http://rdaregistry.info/Elements/m/#P30011",
-            "http://rdvocab.info/Elements/dateOfPublicationManifestation"],
-        "Place" : [
-            "http://rdaregistry.info/Elements/m/#P30279",
-            "http://rdvocab.info/Elements/placeOfPublication"],
-        "Publisher" : [
-            "http://rdaregistry.info/Elements/m/#P30176",
-            "http://rdvocab.info/Elements/publishersName"],
-        "Publisher (full)" : ["http://purl.org/dc/terms/publisher"],
-        "Notes" : [
-            "http://rdaregistry.info/Elements/u/#P60470",
-            "http://rdvocab.info/Elements/note"],
-        "Facsimile" : [
-            "http://data.bnf.fr/ontology/bnf-onto/OCR",
-            "http://rdaregistry.info/Elements/m/#P30016",
-            "http://rdvocab.info/RDARelationshipsWEMI/electronicReproduction"],
-        "BnF identifier" : ["http://data.bnf.fr/ontology/bnf-onto/FRBNF"],
-        "Description" : ["http://purl.org/dc/terms/description"]
-    }
+    df = df.reset_index(drop=True)
+
+    # Every column is needed, even if a query had no results at all.
+    for col in ["propriété", "valeur", "role", "dude", "nomFamille",
+                "prénom"]:
+        if col not in df:
+            df[col] = None
+
+    # Name the contributors harvested as URIs (older journals
+    # hold their names already). Persons without names are left out;
+    # those who could not be asked for are named by their URI.
+    if names is not None:
+        unnamed = df["dude"].notna() & df["nomFamille"].isna()
+        named = df[unnamed].drop(columns=["nomFamille", "prénom"]).merge(
+            names, on="dude")
+        df = pd.concat([df[~unnamed], named], ignore_index=True)
+
+    # The queries basically got out three triplets:
+    # ?link ?propriété ?valeur
+    # ?correspondingExpression ?role ?dude
+    # Each row holds a ?propriété, a ?role, or both.
+    has_p = df["propriété"].notna()
+    has_r = df["role"].notna()
+
+    # Only keep the links which have both properties and contributors.
+    keep = df["Source"].isin(df.loc[has_p, "Source"].unique()) & \
+        df["Source"].isin(df.loc[has_r, "Source"].unique())
+    df = df[keep]
+    has_p = has_p[keep]
+    has_r = has_r[keep]
+
+    # No book at all: an empty table, with every column.
+    if len(df) == 0:
+        return pd.DataFrame(columns=COLUMNS, dtype=object)
+
+    # All remaining metadata are first sorted into the new columns,
+    # with a column for unforeseen metadata.
+    p = df.loc[has_p, "propriété"]
+    v = df.loc[has_p, "valeur"]
+    prop_col = p.map(PROPERTY_COLUMNS)
+    prop_value = v.where(prop_col != "Date", v.str.replace(
+        "http://data.bnf.fr/date/", "", regex=False).str.replace(
+        "/", "", regex=False))
+    prop_value = prop_value.where(prop_col.notna(), p + " → " + v)
+    props = pd.DataFrame({
+        "Source": df.loc[has_p, "Source"],
+        "column": prop_col.fillna("Other"),
+        "value": prop_value})
+
+    # Now deal with contributors, according to their actual roles,
+    # after reconstituting their full names.
+    r = df.loc[has_r, "role"]
+    dude = (df.loc[has_r, "nomFamille"].astype(str) + ", "
+            + df.loc[has_r, "prénom"].astype(str)).str.replace(
+        ", $", "", regex=True)
+    role_col = r.map(ROLE_COLUMNS).mask(
+        r.str.strip().isin(SORT["Author"]), "Author")
+    dudes = pd.DataFrame({
+        "Source": df.loc[has_r, "Source"],
+        "column": role_col.fillna("Other contributor"),
+        "value": dude.where(role_col.notna(), r + " → " + dude)})
+
+    # Remove doubles.
+    long = pd.concat([props, dudes]).drop_duplicates()
+
+    # As an author may also be listed as a contributor,
+    # and we want to avoid annoying doubles, drop those contributors.
+    main = long[long["column"].isin(["Author", "Sc. editor"])]
+    main = pd.MultiIndex.from_frame(main[["Source", "value"]])
+    doubles = (long["column"] == "Contributor") & pd.MultiIndex.from_frame(
+        long[["Source", "value"]]).isin(main)
+    long = long[~doubles]
+
+    # Join the sorted values of each link and column: every value but
+    # the first of its group brings its separator, and the sum of each
+    # group (a vectorised groupby) concatenates them.
+    long = long.sort_values(["Source", "column", "value"])
+    source, column = long["Source"], long["column"]
+    first = (source != source.shift()) | (column != column.shift())
+    value = long["value"].astype(object)
+    grouped = value.where(first, " ; " + value).groupby(
+        [source, column]).sum()
+
+    # One row per link, with every column, in order.
+    sources = np.sort(df["Source"].unique().astype(object))
+    new_df = grouped.unstack("column").reindex(index=sources)
+    new_df["Source"] = sources
+    new_df = new_df.reindex(columns=COLUMNS).reset_index(drop=True)
+    new_df.columns.name = None
+
+    # In case some information is not there.
+    return new_df.astype(object).where(new_df.notna(), None)
 
-    # Initiate the new DataFrame-to-be.
-    new_df = {
-        "Title" : [],
-        "Author" : [],
-        "Sc. editor" : [],
-        "Contributor" : [],
-        "Other contributor" : [],
-        "Edition" : [],
-        "Date" : [],
-        "Place" : [],
-        "Publisher" : [],
-        "Publisher (full)" : [],
-        "Notes" : [],
-        "Source" : [],
-        "Facsimile" : [],
-        "BnF identifier" : [],
-        "Description" : [],
-        "Other" : []
-    }
+######################################################
 
-    # Loop on each original link.
-    for source in np.unique(df["Source"]):
-
-        # Separate the current link information.
-        this_one = df[df["Source"] == source]
-
-        # Initiate the corresponding row.
-        s = {
-        "Title" : [],
-        "Author" : [],
-        "Sc. editor" : [],
-        "Contributor" : [],
-        "Other contributor" : [],
-        "Edition" : [],
-        "Date" : [],
-        "Place" : [],
-        "Publisher" : [],
-        "Publisher (full)" : [],
-        "Notes" : [],
-        "Source" : [],
-        "Facsimile" : [],
-        "BnF identifier" : [],
-        "Description" : [],
-        "Other" : []
-        }
+# HAND THE TABLE OVER TO THE LAYOUT
+
+# The formats of the table between parse_list() and author_date(),
+# by file extension. Arrow IPC files are also called Feather files.
+TABLE_FORMATS = {
+    ".parquet": "parquet",
+    ".arrow": "arrow",
+    ".feather": "arrow",
+    ".ipc": "arrow",
+    ".xlsx": "xlsx"
+}
+
+# The columns whose values repeat from one book to another,
+# stored once in a dictionary rather than in every row.
+DICTIONARY_COLUMNS = [
+    "Author",
+    "Sc. editor",
+    "Contributor",
+    "Other contributor",
+    "Edition",
+    "Date",
+    "Place",
+    "Publisher",
+    "Publisher (full)"
+]
+
+def table_format(path):
+    # Tell the format of a table from the extension of its path.
+    extension = os.path.splitext(str(path))[1].lower()
+    if extension not in TABLE_FORMATS:
+        raise ValueError(f"{path}: use a .parquet, .arrow or .xlsx file.")
+    return TABLE_FORMATS[extension]
+
+def import_pyarrow():
+    # pyarrow is only needed for Parquet and Arrow files.
+    try:
+        import pyarrow
+        import pyarrow.feather
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("Parquet and Arrow files need pyarrow "
+                          "(pip install pyarrow), or use an .xlsx path.")
+    return pyarrow
+
+def write_table(df, path, dictionary=None):
 
-        # Loop on all rows of the link's subset.
-        for index, row in this_one.iterrows():
-            
-            # The query basically got out three triplets:
-            # ?link ?propriété ?valeur
-            # ?correspondingExpression ?role ?dude
-            # First we get what ?propriété and ?role are expressed in this row
-            # and reconstitute the current contributor's full name.
-            p = row["propriété"]
-            r = row["role"]
-            dude = f"{row['nomFamille']}, {row['prénom']}"
-
-            # All remaining metadata are first sorted into the new columns.
-            if p in sort["Title"]:
-                s["Title"].append(row["valeur"])
-            elif p in sort["Edition"]:
-                s["Edition"].append(row["valeur"])
-            elif p in sort["Date"]:
-                s["Date"].append(row["valeur"].replace("http://data.bnf.fr/date/", "").replace("/",""))
-            elif p in sort["Place"]:
-                s["Place"].append(row["valeur"])
-            elif p in sort["Publisher"]:
-                s["Publisher"].append(row["valeur"])
-            elif p in sort["Publisher (full)"]:
-                s["Publisher (full)"].append(row["valeur"])
-            elif p in sort["Notes"]:
-                s["Notes"].append(row["valeur"])
-            elif p in sort["BnF identifier"]:
-                s["BnF identifier"].append(row["valeur"])
-            elif p in sort["Facsimile"]:
-                s["Facsimile"].append(row["valeur"])
-            elif p in sort["Description"]:
-                s["Description"].append(row["valeur"])
-            else:
-                # A column for unforeseen metadata.
-                s["Other"].append(f"{row['propriété']} → {row['valeur']}")
-
-            # Now deal with contributors, according to their actual roles.
-            if r.strip() in sort["Author"]:
-                s["Author"].append(dude)
-            elif r in sort["Sc. editor"]:
-                s["Sc. editor"].append(dude)
-            elif r in sort["Contributor"]:
-                s["Contributor"].append(dude)
-            else:
-                s["Other contributor"].append(f"{r} → {dude}")
-
-        # As an author may also be listed as a contributor,
-        # and we want to avoid annoying doubles, compare the lists.
-        for c in s["Contributor"]:
-            if c in s["Author"] or c in s["Sc. editor"]:
-                s["Contributor"].remove(c)
-
-        # Now add all information to the output-to-be.
-        for k in s.keys():
-            # In case some information is not there.
-            if len(s[k]) == 0:
-                new_df[k].append(None)
-            else:
-                # Keep checking on contributor doubles, just in case.
-                if k == "Contributor":
-                    new_k = []
-                    for c in s[k]:
-                        if c not in s["Author"] and c not in s["Sc. editor"]:
-                            new_k.append(c)
-                    if len(new_k) == 0:
-                        new_df[k].append(None)
-                    else:
-                        new_df[k].append(" ; ".join(np.unique(new_k)))
-                
-                # Otherwise, just add.
-                else:
-                    new_df[k].append(" ; ".join(np.unique(s[k])))
-    return new_df
+    """
+    This function writes the table produced by reorder() into
+    a Parquet, Arrow IPC or XLSX file, depending on its extension.
+
+    :param df: A Pandas DataFrame.
+    :param path: A string containing the path to the output file.
+    :param dictionary: The columns to dictionary-encode in Parquet and
+        Arrow files (True for all, False for none, None for
+        DICTIONARY_COLUMNS).
+    
+    """
+
+    fmt = table_format(path)
+    if fmt == "xlsx":
+        df.to_excel(path)
+        return
+
+    pa = import_pyarrow()
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    if dictionary is None:
+        dictionary = DICTIONARY_COLUMNS
+    elif dictionary is True:
+        dictionary = table.column_names
+    elif not dictionary:
+        dictionary = []
+    # Columns without any value have nothing to encode.
+    dictionary = [c for c in dictionary if c in table.column_names
+                  and table.column(c).null_count < len(table)]
+
+    if fmt == "parquet":
+        pa.parquet.write_table(table, path, use_dictionary=dictionary or False)
+    else:
+        for name in dictionary:
+            i = table.schema.get_field_index(name)
+            table = table.set_column(i, name, table.column(i).dictionary_encode())
+        pa.feather.write_feather(table, path)
+
+def read_table(path):
+
+    """
+    This function reads a table written by write_table() (or an
+    XLSX file produced by an older parse_list()), with None for
+    missing values, as reorder() returns it.
+
+    :param path: A string containing the path to the input file.
+    
+    """
+
+    fmt = table_format(path)
+    if fmt == "xlsx":
+        df = pd.read_excel(path, index_col=0)
+    else:
+        pa = import_pyarrow()
+        if fmt == "parquet":
+            table = pa.parquet.read_table(path)
+        else:
+            table = pa.feather.read_table(path)
+        df = table.to_pandas()
+
+    return df.astype(object).where(df.notna(), None)
 
 ######################################################
 
 # APPLY OXFORD-STYLE LAYOUT
 
-def author_date(df):
+# The formats of the bibliography, by file extension.
+# DOCX and HTML files are laid out with a style, the others
+# hold the fields of each record for reference managers.
+BIBLIO_FORMATS = {
+    ".docx": "docx",
+    ".html": "html",
+    ".htm": "html",
+    ".bib": "bibtex",
+    ".ris": "ris",
+    ".json": "csl-json"
+}
+
+def biblio_format(path):
+    # Tell the format of a bibliography from the extension of its path.
+    extension = os.path.splitext(str(path))[1].lower()
+    if extension not in BIBLIO_FORMATS:
+        raise ValueError(f"{path}: use a .docx, .html, .bib, .ris "
+                         "or .json (CSL-JSON) file.")
+    return BIBLIO_FORMATS[extension]
+
+def author_date(df, output="biblio.docx", metrics=None, streaming=True,
+                workers=1, shard_size=2000, style=None):
 
     """
-    This function takes an XLSX file as produced by the parse_list() function
+    This function takes the table produced by the parse_list() function
     and prepares a DOCX bibliography in Author-Date or Oxford Style layout.
 
-    :param df: A string containing the path to the XLSX input file.
+    :param df: The Pandas DataFrame returned by parse_list(), or
+        a string containing the path to the table it wrote:
+        a .parquet, .arrow or .xlsx file.
+    :param output: A string containing the path to the output file,
+        or a list of them: the format of each file follows its
+        extension (see BIBLIO_FORMATS). The table is only read
+        and parsed once for all of them.
+    :param metrics: A Metrics object recording the time spent
+        in each step, or None.
+    :param streaming: If True, write the entries into the DOCX file
+        as they are laid out, in constant memory. If False, build the
+        whole document with python-docx first.
+    :param workers: The number of processes laying out the entries
+        (None for one per core). The output is the same as with one.
+    :param shard_size: The number of entries given to a process at a time.
+    :param style: The style of the entries (see OXFORD_STYLE),
+        OXFORD_STYLE by default.
     
     """
 
-    # Initiate the output.
-    doc = Document()
+    if metrics is None:
+        metrics = NO_METRICS
+    metrics.start()
 
     # Acquire and prepare the DataFrame.
-    mddd = pd.read_excel("iiif_metadata.xlsx")
-    mdd = mddd.replace(np.nan, None)
-    md = mdd.sort_values(by="Author")
-    
-    for idx, row in md.iterrows():
+    if isinstance(df, pd.DataFrame):
+        mdd = df.astype(object).where(df.notna(), None)
+    else:
+        with metrics.stage("read " + table_format(df)):
+            mdd = read_table(df)
+    with metrics.stage("prepare"):
+        md = mdd.sort_values(by="Author")
+
+    # A single output is written as the rows are parsed.
+    # Several outputs share the same parsed records.
+    if isinstance(output, (str, os.PathLike)):
+        outputs = [output]
+        records = parse_records(md)
+    else:
+        outputs = output
+        with metrics.stage("parse"):
+            records = list(parse_records(md))
 
-        # Make one paragraph per row and prepare contributor list.
-        paragraph = doc.add_paragraph()
-        all_dudes = []
-        
-        if row["Author"] != None:
-            authors = row["Author"].split(" ; ")
-            for idx, author in enumerate(authors, 1):
-                name = author.split(", ")
-                all_dudes.append({"order":idx, "fct":"auth", "fam":name[0], "given":name[1]})
-                
-        if row["Sc. editor"] != None:
-            editors = row["Sc. editor"].split(" ; ")
-            for idx, editor in enumerate(editors, ):
-                name = editor.split(", ")
-                all_dudes.append({"order":idx, "fct":"ed", "fam":name[0], "given":name[1]})
-                
-        if row["Contributor"] != None:
-            contribs = row["Contributor"].split(" ; ")
-            for idx, contrib in enumerate(contribs, 1):
-                name = contrib.split(", ")
-                all_dudes.append({"order":idx, "fct":"contrib", "fam":name[0], "given":name[1]})
-                
-        if row["Other contributor"] != None:
-            contribs = row["Other contributor"].split(" ; ")
-            for idx, contrib in enumerate(contribs, 1):
-                name = contrib.split(", ")
-                all_dudes.append({"order":idx, "fct":"contrib", "fam":name[0], "given":name[1]})
-                
-        # Write the actual contributor list.
-        
-        if len(all_dudes) == 0:
-            paragraph.add_run(text = "Anonyme")
-            
-        elif len(all_dudes) == 1:
-            them = all_dudes[0]
-            ln = paragraph.add_run(text = them["fam"])
-            ln.font.small_caps = True
-            paragraph.add_run(text = ", " + them["given"])
-            if them["fct"] == "ed":
-                paragraph.add_run(text = "(ed.). ")
-                
-        elif len(all_dudes) == 2:
-            them = all_dudes[0]
-            ln = paragraph.add_run(text = them["fam"])
-            ln.font.small_caps = True
-            paragraph.add_run(text = ", " + them["given"])
-            if them["fct"] == "ed":
-                paragraph.add_run(text = "(ed.)")
-            paragraph.add_run(text = " et ")
-            
-            them = all_dudes[1]
-            ln = paragraph.add_run(text = them["fam"])
-            ln.font.small_caps = True
-            paragraph.add_run(text = ", " + them["given"])
-            if them["fct"] == "ed":
-                paragraph.add_run(text = "(ed.)")
-                
-        elif len(all_dudes) > 2:
-            
-            print(all_dudes)
-            ld = len(all_dudes)
-            for idx, dud in enumerate(all_dudes):
-    
-                if ld-idx >= 3 :
-                    ln = paragraph.add_run(text = dud["fam"])
-                    ln.font.small_caps = True
-                    paragraph.add_run(text = ", " + dud["given"])
-                    if dud["fct"] == "ed":
-                        paragraph.add_run(text = "(ed.)")
-                    paragraph.add_run(text = ", ")
-    
-                elif ld-idx == 2:
-    
-                    ln = paragraph.add_run(text = dud["fam"])
-                    ln.font.small_caps = True
-                    paragraph.add_run(text = ", " + dud["given"])
-                    if dud["fct"] == "ed":
-                        paragraph.add_run(text = "(ed.)")
-                    paragraph.add_run(text = " et ")
-                    
-                elif ld-idx == 1:
-            
-                    ln = paragraph.add_run(text = dud["fam"])
-                    ln.font.small_caps = True
-                    paragraph.add_run(text = ", " + dud["given"])
-                    if dud["fct"] == "ed":
-                        paragraph.add_run(text = "(ed.)")
+    # The style is compiled once for all outputs.
+    render = compile_style(style)
+    for path in outputs:
+        write_bibliography(records, path, render, streaming=streaming,
+                           workers=workers, shard_size=shard_size,
+                           metrics=metrics)
 
-        # Add the rest.
-        
-        paragraph.add_run(text = f". [1e édition ??] ({row['Date']}")
-    
-        if row["Edition"] != None:
-            paragraph.add_run(text = ", " + row["Edition"])
+    metrics.stop()
+
+def write_bibliography(records, output, render=None, streaming=True,
+                       workers=1, shard_size=2000, metrics=None):
+
+    """
+    This function writes records returned by parse_records() into
+    a bibliography, in the format given by the extension of its path.
+
+    :param records: An iterable of records, as returned by parse_record().
+    :param output: A string containing the path to the output file.
+    :param render: The style of the entries, as compiled by
+        compile_style(), OXFORD_STYLE by default. Only DOCX and
+        HTML files use it.
+    :param streaming: If True, write DOCX files as the entries are laid
+        out. If False, build the whole document with python-docx first.
+    :param workers: The number of processes laying out the entries
+        (None for one per core).
+    :param shard_size: The number of entries given to a process at a time.
+    :param metrics: A Metrics object recording the time spent
+        in each step, or None.
     
-        
-        paragraph.add_run(text = "). ")
-        tit = paragraph.add_run(text = row["Title"])
-        tit.italic = True
-        paragraph.add_run(text = ". ")
-        
-        if row["Description"] != None:
-            paragraph.add_run(text = row["Description"] + ". ")
-        
-        if row["Place"] != None:
-            pp = row["Place"].split(" ; ")
-            places = []
-            for p in pp:
-                places.append(p.split(" (")[0])
-            paragraph.add_run(text = ", ".join(np.unique(places)) + " : ")
+    """
+
+    if metrics is None:
+        metrics = NO_METRICS
+    fmt = biblio_format(output)
+
+    if fmt in ("docx", "html"):
+        items = render_entries(records, render, workers, shard_size)
+        if fmt == "html":
+            write = write_html
+        elif streaming:
+            write = stream_docx
+        else:
+            write = write_docx
+    else:
+        items = records
+        write = BIBLIO_WRITERS[fmt]
+
+    # The entries are laid out as the output is written.
+    # The time spent waiting for them is the time spent rendering.
+    rendering = {"seconds": 0.0}
+    def entries():
+        items_ = iter(items)
+        while True:
+            start = time.perf_counter()
+            item = next(items_, None)
+            rendering["seconds"] += time.perf_counter() - start
+            if item is None:
+                return
+            yield item
+
+    start = time.perf_counter()
+    write(entries(), output)
+    metrics.add("render", rendering["seconds"])
+    metrics.add("save", time.perf_counter() - start - rendering["seconds"])
+
+######################################################
+
+# PARSE THE ROWS OF THE TABLE INTO RECORDS
+
+# The columns holding contributors, with their role in the records.
+NAME_COLUMNS = [
+    ("Author", "auth"),
+    ("Sc. editor", "ed"),
+    ("Contributor", "contrib"),
+    ("Other contributor", "contrib")
+]
+
+def parse_records(md):
+    # Parse the rows of a table one at a time, in order.
+    # Rows as dictionaries, for iterrows() may turn None into NaN.
+    for values in md.itertuples(index=False, name=None):
+        yield parse_record(dict(zip(md.columns, values)))
+
+def parse_record(row):
+
+    """
+    This function parses one row of the table into a record, the same
+    for every style and format: contributor names are split into
+    family and given names, and places are listed once, without
+    their country.
+
+    :param row: A dictionary with the columns of the table as keys.
     
-        if row["Publisher"] != None:
-            paragraph.add_run(text = row["Publisher"])
-        paragraph.add_run(text = ". ")
+    """
+
+    names = []
+    for column, role in NAME_COLUMNS:
+        if row[column] != None:
+            for name in row[column].split(" ; "):
+                # Persons who could not be named only have their URI.
+                family, _, given = name.partition(", ")
+                names.append({"role": role, "family": family,
+                              "given": given})
+
+    places = []
+    if row["Place"] != None:
+        places = sorted({p.split(" (")[0] for p in row["Place"].split(" ; ")})
+
+    return {
+        "names": names,
+        "title": row["Title"],
+        "date": row["Date"],
+        "edition": row["Edition"],
+        "description": row["Description"],
+        "places": places,
+        "publisher": row["Publisher"],
+        "facsimile": row["Facsimile"],
+        "notes": row.get("Notes"),
+        "identifier": row.get("BnF identifier"),
+        "source": row.get("Source")
+    }
+
+######################################################
+
+# COMPILE THE STYLES OF THE ENTRIES
+
+# The Author-Date or Oxford Style.
+# "names" lays out the contributors: each one is "family" and "given",
+# followed by the mark of its role, if any ("sole" when it is alone),
+# and separated from the next one by "separator" (or "last separator").
+# Without contributors, the entry starts with "anonymous".
+# Each of the "parts" which follow is (field, template, flags): the
+# template is filled with the fields of the record (lists are joined
+# with ", "), and the part is left out when its field is empty (a field
+# of None keeps it always). Flags are "small caps" and "italic".
+OXFORD_STYLE = {
+    "names": {
+        "anonymous": "Anonyme",
+        "family": ("{family}", "small caps"),
+        "given": (", {given}", ""),
+        "roles": {"ed": "(ed.)"},
+        "sole": {"ed": "(ed.). "},
+        "separator": ", ",
+        "last separator": " et "
+    },
+    "parts": [
+        (None, ". [1e édition ??] ({date}", ""),
+        ("edition", ", {edition}", ""),
+        (None, "). ", ""),
+        ("title", "{title}", "italic"),
+        (None, ". ", ""),
+        ("description", "{description}. ", ""),
+        ("places", "{places} : ", ""),
+        ("publisher", "{publisher}", ""),
+        (None, ". ", ""),
+        ("facsimile", "En ligne : {facsimile}.", "")
+    ]
+}
+
+def compile_template(template, flags=""):
+
+    """
+    This function compiles a template of a style into a function
+    which fills it with the fields of a record (or a name), and
+    returns the resulting run as a (text, small_caps, italic) tuple.
+
+    :param template: A string with fields between braces, e.g. "{title}".
+    :param flags: A string with "small caps" and/or "italic", or nothing.
     
-        if row["Facsimile"] != None:
-            paragraph.add_run(text = "En ligne : " + row["Facsimile"] + ".")
+    """
+
+    small_caps = "small caps" in flags
+    italic = "italic" in flags
+    pieces = [(literal, field) for literal, field, _, _
+              in string.Formatter().parse(template)]
+
+    # Templates without fields, or with a single one, are most common.
+    if all(field is None for _, field in pieces):
+        run = (template, small_caps, italic)
+        return lambda record: run
+    if len(pieces) == 1:
+        literal, field = pieces[0]
+        return lambda record: (literal + field_text(record[field]),
+                               small_caps, italic)
+
+    def fill(record):
+        text = "".join(literal + field_text(record[field])
+                       if field is not None else literal
+                       for literal, field in pieces)
+        return (text, small_caps, italic)
+    return fill
+
+def field_text(value):
+    # Put a field into words.
+    if isinstance(value, list):
+        return ", ".join(value)
+    return str(value)
+
+def compile_style(style=None):
+
+    """
+    This function compiles a style once into a function which
+    lays out a record as a bibliographical entry. The entry
+    is returned as a list of (text, small_caps, italic) runs,
+    ready for any of the layout writers.
+
+    :param style: A style, as OXFORD_STYLE (the default).
     
-    # Write the output into a DOCX file.
-    doc.save("biblio.docx")
+    """
 
-        
+    if style is None:
+        style = OXFORD_STYLE
+
+    names = style["names"]
+    anonymous = (names["anonymous"], False, False)
+    family = compile_template(*names["family"])
+    given = compile_template(*names["given"])
+    roles = {role: (mark, False, False)
+             for role, mark in names["roles"].items()}
+    sole = dict(roles, **{role: (mark, False, False)
+                          for role, mark in names["sole"].items()})
+    separator = (names["separator"], False, False)
+    last_separator = (names["last separator"], False, False)
+
+    parts = [(field, compile_template(template, flags))
+             for field, template, flags in style["parts"]]
+
+    def render(record):
+        runs = []
+
+        # Write the contributor list.
+        dudes = record["names"]
+        marks = sole if len(dudes) == 1 else roles
+        if len(dudes) == 0:
+            runs.append(anonymous)
+        for idx, dud in enumerate(dudes, 1):
+            runs.append(family(dud))
+            # Persons named by their URI have no given name.
+            if dud["given"]:
+                runs.append(given(dud))
+            if dud["role"] in marks:
+                runs.append(marks[dud["role"]])
+            if idx < len(dudes) - 1:
+                runs.append(separator)
+            elif idx == len(dudes) - 1:
+                runs.append(last_separator)
+
+        # Add the rest.
+        for field, fill in parts:
+            if field is None or record[field] not in (None, []):
+                runs.append(fill(record))
 
+        return runs
 
+    # The worker processes of render_entries() compile it again.
+    render.style = style
+    return render
 
+def render_entries(records, render=None, workers=1, shard_size=2000):
 
+    """
+    This function lays out records as bibliographical entries, in
+    order. With several workers, the records are cut into shards laid
+    out by a pool of processes, and the shards are put back in order as
+    they come, so the output does not depend on the number of workers.
+
+    It yields the runs of each entry, as returned by compile_style().
+
+    :param records: An iterable of records, as returned by parse_record().
+    :param render: The style of the entries, as compiled by
+        compile_style(), OXFORD_STYLE by default.
+    :param workers: The number of processes (None for one per core).
+    :param shard_size: The number of records given to a process at a time.
+    
+    """
+
+    if render is None:
+        render = compile_style()
+    if workers is None:
+        workers = os.cpu_count() or 1
+    records = iter(records)
+    shards = iter(lambda: list(islice(records, shard_size)), [])
+
+    # A single shard is not worth a pool.
+    first = next(shards, [])
+    if workers <= 1 or len(first) < shard_size:
+        yield from map(render, first)
+        yield from map(render, records)
+        return
+
+    # Keep only a few shards ahead of the output in memory.
+    # Compiled styles cannot be sent to the processes: each one
+    # compiles the style once, when it starts.
+    with ProcessPoolExecutor(max_workers=workers, initializer=worker_style,
+                             initargs=(render.style,)) as pool:
+        pending = deque([pool.submit(shard_runs, first)])
+        for shard in shards:
+            pending.append(pool.submit(shard_runs, shard))
+            if len(pending) >= 2 * workers:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+# The style compiled by a worker process of render_entries().
+_worker_render = None
+
+def worker_style(style):
+    # Compile the style of a worker process, once.
+    global _worker_render
+    _worker_render = compile_style(style)
+
+def shard_runs(records):
+    # Lay out a shard of records in a worker process.
+    return list(map(_worker_render, records))
+
+def write_docx(entries, path):
 
+    """
+    This function writes bibliographical entries into a DOCX file
+    with python-docx, one paragraph per entry.
 
+    :param entries: An iterable of lists of (text, small_caps, italic)
+        tuples, as returned by compile_style().
+    :param path: A string containing the path to the DOCX output file.
+    
+    """
 
+    from docx import Document
 
+    doc = Document()
+    for runs in entries:
+        paragraph = doc.add_paragraph()
+        for text, small_caps, italic in runs:
+            run = paragraph.add_run(text = text)
+            if small_caps:
+                run.font.small_caps = True
+            if italic:
+                run.italic = True
+    doc.save(path)
+
+######################################################
+
+# WRITE VERY LARGE DOCX FILES
+
+# Characters which XML 1.0 does not allow in a document.
+XML_ILLEGAL = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]")
+
+# python-docx turns tabs and line breaks into their own elements.
+RUN_BREAKS = re.compile("([\t\n\r])")
+
+def docx_template():
+    # The empty document python-docx starts from,
+    # with its styles, fonts and page layout.
+    import docx
+    return os.path.join(os.path.dirname(docx.__file__),
+                        "templates", "default.docx")
+
+def run_xml(text, small_caps=False, italic=False):
+    # The WordprocessingML of a run, as python-docx writes it.
+    properties = ""
+    if italic:
+        properties += "<w:i/>"
+    if small_caps:
+        properties += "<w:smallCaps/>"
+    if properties:
+        properties = "<w:rPr>" + properties + "</w:rPr>"
+
+    content = []
+    for piece in RUN_BREAKS.split(XML_ILLEGAL.sub("", text or "")):
+        if piece == "\t":
+            content.append("<w:tab/>")
+        elif piece in ("\n", "\r"):
+            content.append("<w:br/>")
+        elif piece:
+            content.append('<w:t xml:space="preserve">%s</w:t>'
+                           % xml_escape(piece))
+
+    return "<w:r>" + properties + "".join(content) + "</w:r>"
+
+def stream_docx(entries, path, buffer_size=1 << 16):
+
+    """
+    This function writes bibliographical entries into a DOCX file
+    as they come, one paragraph per entry, without building the
+    document in memory. The styles and page layout are those of
+    the python-docx default document, so the output looks the same
+    as with write_docx().
+
+    :param entries: An iterable of lists of (text, small_caps, italic)
+        tuples, as returned by compile_style().
+    :param path: A string containing the path to the DOCX output file.
+    :param buffer_size: The number of characters to gather before
+        compressing them into the file.
+    
+    """
 
+    with zipfile.ZipFile(docx_template()) as template, \
+            zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as out:
+        for item in template.infolist():
+            if item.filename != "word/document.xml":
+                out.writestr(item, template.read(item))
+                continue
+
+            # Write the paragraphs between the opening of the body
+            # and the page layout of the template.
+            xml = template.read(item).decode("utf-8")
+            body = xml.index("<w:body>") + len("<w:body>")
+            section = xml.index("<w:sectPr", body)
+
+            # Keep the date of the template, so that the same
+            # entries always give the same file.
+            document = zipfile.ZipInfo(item.filename, item.date_time)
+            document.compress_type = zipfile.ZIP_DEFLATED
+            with out.open(document, "w", force_zip64=True) as f:
+                buffer = [xml[:body]]
+                size = 0
+                for runs in entries:
+                    paragraph = "<w:p>" + "".join(
+                        run_xml(*run) for run in runs) + "</w:p>"
+                    buffer.append(paragraph)
+                    size += len(paragraph)
+                    if size >= buffer_size:
+                        f.write("".join(buffer).encode("utf-8"))
+                        buffer, size = [], 0
+                buffer.append(xml[section:])
+                f.write("".join(buffer).encode("utf-8"))
 
+######################################################
 
+# WRITE THE BIBLIOGRAPHY IN OTHER FORMATS
 
+def write_html(entries, path):
 
+    """
+    This function writes bibliographical entries into an HTML file,
+    one paragraph per entry.
 
+    :param entries: An iterable of lists of (text, small_caps, italic)
+        tuples, as returned by compile_style().
+    :param path: A string containing the path to the HTML output file.
+    
+    """
 
+    with open(path, "w", encoding="utf-8") as f:
+        f.write('<!DOCTYPE html>\n<html>\n<head>\n<meta charset="utf-8">\n'
+                '<title>Bibliographie</title>\n</head>\n<body>\n')
+        for runs in entries:
+            paragraph = []
+            for text, small_caps, italic in runs:
+                text = html.escape(text or "", quote=False)
+                if italic:
+                    text = "<i>" + text + "</i>"
+                if small_caps:
+                    text = ('<span style="font-variant: small-caps">'
+                            + text + "</span>")
+                paragraph.append(text)
+            f.write("<p>" + "".join(paragraph) + "</p>\n")
+        f.write("</body>\n</html>\n")
+
+# The BibTeX and RIS fields of the records.
+BIBTEX_ROLES = {"auth": "author", "ed": "editor"}
+RIS_ROLES = {"auth": "AU", "ed": "ED", "contrib": "A4"}
+CSL_ROLES = {"auth": "author", "ed": "editor", "contrib": "contributor"}
+
+def record_key(record, keys):
+    # A BibTeX key for a record, e.g. Zola1877, then Zola1877a...
+    family = record["names"][0]["family"] if record["names"] else "Anonyme"
+    key = re.sub(r"\W", "", family + str(record["date"] or ""))
+    suffix = keys.get(key, 0)
+    keys[key] = suffix + 1
+    if suffix == 0:
+        return key
+    return key + "abcdefghijklmnopqrstuvwxyz"[(suffix - 1) % 26] * (
+        (suffix - 1) // 26 + 1)
+
+def bibtex_escape(value):
+    # Escape the characters which BibTeX would interpret.
+    return re.sub(r"([&%$#_{}])", r"\\\1", str(value))
+
+def write_bibtex(records, path):
 
+    """
+    This function writes records into a BibTeX file,
+    one @book entry per record.
 
+    :param records: An iterable of records, as returned by parse_record().
+    :param path: A string containing the path to the BibTeX output file.
+    
+    """
 
+    keys = {}
+    with open(path, "w", encoding="utf-8") as f:
+        for record in records:
+            fields = []
+            for role, field in BIBTEX_ROLES.items():
+                names = [", ".join(filter(None, [n["family"], n["given"]]))
+                         for n in record["names"] if n["role"] == role]
+                if len(names) != 0:
+                    fields.append((field, " and ".join(names)))
+            for field, value in [("title", record["title"]),
+                                 ("year", record["date"]),
+                                 ("edition", record["edition"]),
+                                 ("address", ", ".join(record["places"])),
+                                 ("publisher", record["publisher"]),
+                                 ("note", record["description"]),
+                                 ("url", record["facsimile"])]:
+                if value:
+                    fields.append((field, value))
+
+            f.write("@book{" + record_key(record, keys) + ",\n")
+            f.write(",\n".join(f"  {field} = {{{bibtex_escape(value)}}}"
+                               for field, value in fields))
+            f.write("\n}\n\n")
+
+def write_ris(records, path):
 
+    """
+    This function writes records into a RIS file,
+    one BOOK reference per record.
 
+    :param records: An iterable of records, as returned by parse_record().
+    :param path: A string containing the path to the RIS output file.
+    
+    """
 
+    with open(path, "w", encoding="utf-8") as f:
+        for record in records:
+            lines = ["TY  - BOOK"]
+            for name in record["names"]:
+                lines.append(f"{RIS_ROLES[name['role']]}  - " + ", ".join(
+                    filter(None, [name["family"], name["given"]])))
+            for tag, value in [("TI", record["title"]),
+                               ("PY", record["date"]),
+                               ("ET", record["edition"]),
+                               ("CY", ", ".join(record["places"])),
+                               ("PB", record["publisher"]),
+                               ("N1", record["description"]),
+                               ("UR", record["facsimile"]),
+                               ("SN", record["identifier"])]:
+                if value:
+                    lines.append(f"{tag}  - {value}")
+            lines.append("ER  - ")
+            f.write("\n".join(lines) + "\n\n")
+
+def csl_item(record, key):
+    # A record as a CSL-JSON item.
+    item = {"id": key, "type": "book"}
+    for name in record["names"]:
+        item.setdefault(CSL_ROLES[name["role"]], []).append(
+            {"family": name["family"], "given": name["given"]})
+    date = record["date"]
+    if date:
+        if str(date).isdigit():
+            item["issued"] = {"date-parts": [[int(date)]]}
+        else:
+            item["issued"] = {"raw": str(date)}
+    for field, value in [("title", record["title"]),
+                         ("edition", record["edition"]),
+                         ("publisher-place", ", ".join(record["places"])),
+                         ("publisher", record["publisher"]),
+                         ("note", record["description"]),
+                         ("URL", record["facsimile"])]:
+        if value:
+            item[field] = value
+    return item
+
+def write_csl_json(records, path):
 
+    """
+    This function writes records into a CSL-JSON file, as read by
+    Zotero, Pandoc or citeproc, one item at a time.
 
+    :param records: An iterable of records, as returned by parse_record().
+    :param path: A string containing the path to the JSON output file.
+    
+    """
 
+    keys = {}
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("[")
+        for idx, record in enumerate(records):
+            f.write(",\n" if idx else "\n")
+            f.write(json.dumps(csl_item(record, record_key(record, keys)),
+                               ensure_ascii=False))
+        f.write("\n]\n")
+
+# The writers of the formats holding records rather than laid out entries.
+BIBLIO_WRITERS = {
+    "bibtex": write_bibtex,
+    "ris": write_ris,
+    "csl-json": write_csl_json
+}